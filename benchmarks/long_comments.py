@@ -0,0 +1,126 @@
+"""
+Benchmark parsing and composing comments with thousands of lines.
+
+Block comments, line comments and paragraphs of about 3k, 10k and 30k lines
+are generated and formatted with a low recursion limit, which shows that the
+depth of the Python stack does not grow with the number of lines. The time
+per thousand lines stays about the same if the time grows linearly.
+
+Run it from anywhere with Python 3.3 or newer:
+
+    python benchmarks/long_comments.py
+"""
+
+import importlib
+import os
+import sys
+import time
+import types
+
+# the recursion limit while parsing and composing, far below the number of
+# lines of the comments
+recursion_limit = 150
+
+# the number of lines of the generated comments
+sizes = (3000, 10000, 30000)
+
+words = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+def import_package():
+    """
+    Import the package this benchmark belongs to.
+
+    The packages of the formatters are registered without running their
+    __init__ modules, which import the Sublime Text API only available in
+    Sublime Text.
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.path.dirname(root))
+    name = os.path.basename(root)
+
+    for package in ("comments", "texts"):
+        module = types.ModuleType(name + "." + package)
+        module.__path__ = [os.path.join(root, package)]
+        sys.modules[module.__name__] = module
+
+    return name
+
+
+def sentence(i):
+    """Return some words for line i."""
+    return " ".join(words[(i + j) % len(words)] for j in range(i % 7 + 3))
+
+
+def block_comment(lines):
+    """Return a Doxygen block comment of about the given lines."""
+
+    text = ["/**\n", " *\t@brief " + sentence(0) + "\n"]
+    i = 1
+    while len(text) < lines - 1:
+        if i % 10 == 0:
+            text.append(" *\n")
+        text.append(" *\t" + sentence(i) + "\n")
+        i += 1
+    text.append(" */\n")
+    return "".join(text)
+
+
+def line_comment(lines):
+    """Return a line comment of the given lines."""
+    return "".join("// " + sentence(i) + "\n" for i in range(lines))
+
+
+def paragraph(lines):
+    """Return a paragraph of the given lines."""
+    return "".join(sentence(i) + "\n" for i in range(lines))
+
+
+def main():
+    """Run the benchmark."""
+
+    package = import_package()
+    pypeg2 = importlib.import_module(package + ".dependencies.pypeg2")
+    grammars = (
+        ("block comment", block_comment, importlib.import_module(
+            package + ".comments.cpp_block_grammar").BlockComment),
+        ("line comment", line_comment, importlib.import_module(
+            package + ".comments.line_grammar").LineComment),
+        ("paragraph", paragraph, importlib.import_module(
+            package + ".texts.paragraph_grammar").Paragraph))
+
+    print("%-14s %7s %9s %9s %12s" % ("", "lines", "parse", "compose",
+                                      "per 1k lines"))
+    for name, generate, grammar in grammars:
+        # the same parser as get_parser creates for a ruler at 80
+        parser = pypeg2.Parser(whitespace=None, autoblank=False)
+        parser.width = 80
+        parser.tab_size = 4
+        parser.optimal_wrapping = False
+
+        for size in sizes:
+            text = generate(size)
+            lines = text.count("\n")
+
+            limit = sys.getrecursionlimit()
+            sys.setrecursionlimit(recursion_limit)
+            try:
+                start = time.time()
+                t, c = parser.parse(text, grammar)
+                parsed = time.time()
+                if t:
+                    raise parser.last_error
+                parser.compose(c)
+                composed = time.time()
+            finally:
+                sys.setrecursionlimit(limit)
+
+            print("%-14s %7d %8.2fs %8.2fs %11.3fs" % (
+                name, lines, parsed - start, composed - parsed,
+                (composed - start) * 1000 / lines))
+
+
+if __name__ == "__main__":
+    main()
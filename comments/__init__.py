@@ -1,6 +1,19 @@
 """Comment formatters."""
 
-from .line import FormatLineComment
-from .cpp_block import FormatDoxygenCppBlockComment
+from .line import (
+    FormatLineComment,
+    extract_line_comment_scope,
+    extract_line_comment_scopes,
+    format_line_comment
+)
+from .cpp_block import (
+    FormatDoxygenCppBlockComment,
+    extract_cpp_block_comment_scope,
+    extract_cpp_block_comment_scopes,
+    format_cpp_block_comment
+)
 
-__all__ = ["FormatLineComment", "FormatDoxygenCppBlockComment"]
+__all__ = ["FormatLineComment", "FormatDoxygenCppBlockComment",
+           "extract_line_comment_scope", "extract_line_comment_scopes",
+           "format_line_comment", "extract_cpp_block_comment_scope",
+           "extract_cpp_block_comment_scopes", "format_cpp_block_comment"]
@@ -1,9 +1,30 @@
 """Format Doxygen C++ block comments."""
 
-import re
-
 from .cpp_block_grammar import BlockComment
-from ..dependencies.pypeg2 import Parser
+from ..common.parsers import format_text, get_parser
+
+
+def extract_cpp_block_comment_scope(view, pos):
+    """Return the scope of the C++ block comment at pos."""
+
+    return view.full_line(view.extract_scope(pos))
+
+
+def extract_cpp_block_comment_scopes(view):
+    """Return the scopes of all C++ block comments in the view."""
+
+    return [view.full_line(c)
+            for c in view.find_by_selector("source.c++ comment.block.c")]
+
+
+def format_cpp_block_comment(view, comment):
+    """Return the formatted Doxygen C++ block comment."""
+
+    # get the parser for the view's settings
+    parser = get_parser(BlockComment, view)
+
+    # format the comment nicely, or take it from the recently formatted ones
+    return format_text(parser, comment, BlockComment)
 
 
 def FormatDoxygenCppBlockComment(view, edit, pos):
@@ -12,28 +33,10 @@ def FormatDoxygenCppBlockComment(view, edit, pos):
         return
 
     # extract the comment from the view
-    scope = view.full_line(view.extract_scope(pos))
+    scope = extract_cpp_block_comment_scope(view, pos)
     comment = view.substr(scope)
 
-    # initialize the parser
-    parser = Parser()
-    parser.text = comment
-    parser.whitespace = re.compile(r"\0")  # disable automatic removal
-    parser.autoblank = False
-
-    # custom parameters for the compose methods
-    rulers = view.settings().get("rulers", [])
-
-    parser.width = (rulers and rulers[0]) or 80
-    parser.tab_size = view.settings().get("tab_size")
-
-    # try to parse the original comment
-    t, c = parser.parse(comment, BlockComment)
-    if t:
-        raise parser.last_error
-
-    # format the comment nicely
-    formatted_comment = parser.compose(c)
+    formatted_comment = format_cpp_block_comment(view, comment)
 
     # update the view
     if formatted_comment != comment:
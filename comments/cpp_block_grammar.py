@@ -6,6 +6,7 @@ import textwrap
 from ..dependencies.pypeg2 import (
     Concat,
     List,
+    Lines,
     Symbol,
     attr,
     blank,
@@ -16,6 +17,8 @@ from ..dependencies.pypeg2 import (
     optional,
     some
 )
+from ..common.columns import columns
+from ..common.wrap import wrap
 
 
 def to_class_name(s):
@@ -42,7 +45,16 @@ commands = ["@brief", "@tparam", "@param", "@return",
             "@code", "@endcode", "@note", "@warning", "@throws", "@see",
             "@related", "@relatedalso",
             r"\|", r"\[.+\]:", r"[\+\-\*]"]
-CommandContents = re.compile(r"(?!\t*(?:" + r"|".join(commands) + r")).+")
+
+# Classify every line once before parsing instead of looking ahead for all
+# commands again whenever a line is tried as a continuation of a paragraph.
+LineKinds = Lines(re.compile(r"\t*(?:(?P<start>/\*\*?$)"
+                             r"|(?P<end>(?:\*\*/| \*/)$)"
+                             r"| \*\t*(?:(?P<separator>$)"
+                             r"|(?P<command>" + r"|".join(commands) + r")"
+                             r"|(?P<text>)))", re.M))
+
+CommandContents = re.compile(r".+")
 
 
 class Start(Concat):
@@ -84,7 +96,8 @@ class SeparatorLine(Concat):
 
 
 class CommandLine(Concat):
-    grammar = attr("prefix", Prefix), attr("contents", CommandContents), "\n"
+    grammar = (attr("prefix", Prefix), LineKinds.kind("text"),
+               attr("contents", CommandContents), "\n")
 
 
 class Separator(List):
@@ -95,7 +108,7 @@ class ContiguousParagraph(List):
     def compose(self, parser, attr_of=None):
         # find the original line prefix and its length in characters
         prefix = parser.compose(self[0].prefix)
-        prefix_length = len(prefix.expandtabs(parser.tab_size))
+        prefix_length = columns(prefix, parser.tab_size)
 
         # construct the header string if any
         header = self.command
@@ -104,18 +117,18 @@ class ContiguousParagraph(List):
 
         # if a specific indentation was requested we need to adjust the header
         parameter_indentation = getattr(self, "parameter_indentation", 0)
-        if parameter_indentation > len(header):
-            header += " " * (parameter_indentation - len(header))
+        if parameter_indentation > columns(header):
+            header += " " * (parameter_indentation - columns(header))
 
         if getattr(self[0], "parameters", None):
             header += parser.compose(self[0].parameters) + " "
 
         # align the content
         content_indentation = getattr(self, "content_indentation", 0)
-        if content_indentation > len(header):
-            header += " " * (content_indentation - len(header))
+        if content_indentation > columns(header):
+            header += " " * (content_indentation - columns(header))
 
-        header_length = len(header)
+        header_length = columns(header)
 
         # add the contents of all lines together
         contents = " ".join([l.contents.strip() for l in self if l.contents])
@@ -124,10 +137,10 @@ class ContiguousParagraph(List):
         indentation_length = prefix_length + header_length
         width = parser.width - indentation_length
 
-        lines = textwrap.wrap(contents, width, break_on_hyphens=False)
+        lines = wrap(contents, width, optimal=parser.optimal_wrapping)
 
-        # construct the header line
-        lines[0] = prefix + header + lines[0] + "\n"
+        # write the header line
+        parser.write(prefix, header, lines[0], "\n")
 
         # calculate the required indentation in tabs and spaces
         indentation_tabs = (int(indentation_length / parser.tab_size)
@@ -135,11 +148,9 @@ class ContiguousParagraph(List):
         indentation_spaces = indentation_length % parser.tab_size
         indentation = "\t" * indentation_tabs + " " * indentation_spaces
 
-        # prepend the prefix and indentation to all other lines
+        # write all other lines with the prefix and indentation
         for i in range(1, len(lines)):
-            lines[i] = prefix + indentation + lines[i] + "\n"
-
-        return "".join(lines)
+            parser.write(prefix, indentation, lines[i], "\n")
 
 
 class BreakingParagraph(List):
@@ -153,24 +164,21 @@ class BreakingParagraph(List):
         contents = " ".join([l.contents.strip() for l in self if l.contents])
 
         # wrap the text at the remaining width after indentation
-        indentation_length = len((prefix + indentation)
-                                 .expandtabs(parser.tab_size))
+        indentation_length = columns(prefix + indentation, parser.tab_size)
         width = parser.width - indentation_length
 
-        lines = textwrap.wrap(contents, width, break_on_hyphens=False)
+        lines = wrap(contents, width, optimal=parser.optimal_wrapping)
 
-        # construct the header line
+        # write the header line
         header = self.command
         if self[0].parameters:
             header += " " + parser.compose(self[0].parameters)
 
-        lines.insert(0, prefix + header + "\n")
-
-        # prepend the prefix and indentation to all other lines
-        for i in range(1, len(lines)):
-            lines[i] = prefix + indentation + lines[i] + "\n"
+        parser.write(prefix, header, "\n")
 
-        return "".join(lines)
+        # write all other lines with the prefix and indentation
+        for line in lines:
+            parser.write(prefix, indentation, line, "\n")
 
 
 class Brief(ContiguousParagraph):
@@ -214,17 +222,18 @@ class Parameters(List):
     def compose(self, parser, attr_of=None):
         # find the common indentation level of all parameters
         parameter_indentation = max(map(
-            lambda p: len(p.command) + 1, self))
+            lambda p: columns(p.command) + 1, self))
         content_indentation = parameter_indentation + max(map(
-            lambda p: len(p[0].parameters) + 1, self))
+            lambda p: columns(p[0].parameters) + 1, self))
 
         # tell the parameter paragraphs of the correct indentation
         for p in self:
             p.parameter_indentation = parameter_indentation
             p.content_indentation = content_indentation
 
-        # compose all parameter paragraphs together
-        return "".join(map(lambda p: parser.compose(p), self))
+        # compose all parameter paragraphs one after another
+        for p in self:
+            parser.compose_into(p)
 
 
 class Returns(ContiguousParagraph):
@@ -277,16 +286,14 @@ class Code(BreakingParagraph):
         if self[0].parameters:
             header += self[0].parameters
 
-        lines.insert(0, prefix + header + "\n")
+        parser.write(prefix, header, "\n")
 
-        # prepend the prefix and indentation to all code lines
-        for i in range(1, len(lines)):
-            lines[i] = (prefix + indentation + lines[i]).rstrip() + "\n"
+        # write all code lines with the prefix and indentation
+        for line in lines:
+            parser.write((prefix + indentation + line).rstrip(), "\n")
 
         # add the @endcode line
-        lines.append(parser.compose(self[-1]))
-
-        return "".join(lines)
+        parser.compose_into(self[-1])
 
 
 class Note(BreakingParagraph):
@@ -348,30 +355,18 @@ class ListItem(List):
         contents = " ".join([l.contents.strip() for l in self if l.contents])
 
         # wrap the text at the remaining width
-        indentation_length = len((prefix + indentation)
-                                 .expandtabs(parser.tab_size))
+        indentation_length = columns(prefix + indentation, parser.tab_size)
         width = parser.width - indentation_length
 
-        wrapper = textwrap.TextWrapper(width=width,
-                                       initial_indent=self[0].start,
-                                       break_long_words=False,
-                                       break_on_hyphens=False)
-
         # indent all but the first lines with an additional level
-        wrapper.subsequent_indent = " " * parser.tab_size
-
-        lines = wrapper.wrap(contents)
-
-        # prepend the prefix and indentation to all lines
-        for i in range(0, len(lines)):
-            # turn the subsequent indentation into a tab character
-            if i > 0:
-                lines[i] = re.sub(r"^" + wrapper.subsequent_indent, "\t",
-                                  lines[i])
-
-            lines[i] = prefix + indentation + lines[i] + "\n"
+        lines = wrap(contents, width, initial_indent=self[0].start,
+                     subsequent_indent="\t", tab_size=parser.tab_size,
+                     break_long_words=False,
+                     optimal=parser.optimal_wrapping)
 
-        return "".join(lines)
+        # write all lines with the prefix and indentation
+        for line in lines:
+            parser.write(prefix, indentation, line, "\n")
 
 
 class BreakingListItemStartLine(Concat):
@@ -394,25 +389,18 @@ class BreakingListItem(BreakingParagraph):
                              if l.contents])
 
         # wrap the text at the remaining width
-        indentation_length = len((prefix + indentation)
-                                 .expandtabs(parser.tab_size))
+        indentation_length = columns(prefix + indentation, parser.tab_size)
         width = parser.width - indentation_length
 
-        wrapper = textwrap.TextWrapper(width=width,
-                                       break_long_words=False,
-                                       break_on_hyphens=False)
+        lines = wrap(contents, width, break_long_words=False,
+                     optimal=parser.optimal_wrapping)
 
-        lines = wrapper.wrap(contents)
-
-        # construct the start line
-        start = parser.compose(self[0])
-        lines.insert(0, start)
-
-        # prepend the prefix and indentation to all other lines
-        for i in range(1, len(lines)):
-            lines[i] = prefix + indentation + lines[i] + "\n"
+        # write the start line
+        parser.compose_into(self[0])
 
-        return "".join(lines)
+        # write all other lines with the prefix and indentation
+        for line in lines:
+            parser.write(prefix, indentation, line, "\n")
 
 
 class ListItems(List):
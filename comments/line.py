@@ -1,27 +1,35 @@
 """Format line comments."""
 
-import re
+from bisect import bisect_right
 
 import sublime
 
 from .line_grammar import LineComment
-from ..dependencies.pypeg2 import Parser
+from ..common.parsers import format_text, get_parser
 
 
-def is_valid_line_comment(view, region):
-    """Check if region contains a line comment."""
+# the number of characters read at once around a line comment while
+# searching for the line comments next to it
+search_window = 4096
 
-    # the region must end in a line comment
-    if (region.empty()
-            or not view.match_selector(region.end() - 1, "comment.line")):
+
+def is_valid_line_comment(text, line, comment):
+    """
+    Check if line contains a line comment.
+
+    Both are given as offsets into text, comment is the line comment at the
+    end of the line if any.
+    """
+
+    # the line must end in a line comment
+    begin, end = line
+    if begin == end or comment is None:
         return False
 
     # now check if everything before the comment consists only of spaces and
-    # tabs (only check this if the comment starts within the region)
-    scope = view.extract_scope(region.end())
-    if region.begin() < scope.begin():
-        indentation = view.substr(sublime.Region(region.begin(),
-                                                 scope.begin()))
+    # tabs (only check this if the comment starts within the line)
+    if begin < comment[0]:
+        indentation = text[begin:comment[0]]
         if indentation and not indentation.isspace():
             return False
 
@@ -31,18 +39,75 @@ def is_valid_line_comment(view, region):
 def extract_line_comment_scope(view, pos):
     """Return the scope of adjacent line comments."""
 
-    # find the current and the last row
-    row = view.rowcol(pos)[0]
-    max_rows = view.rowcol(view.size())[0]
+    # find all line comments at once and the one at pos
+    comments = view.find_by_selector("comment.line")
+    begins = [c.begin() for c in comments]
+    index = bisect_right(begins, pos) - 1
+    if index < 0 or comments[index].end() <= pos:
+        return None
+
+    # collect the comments above and below which are only separated by
+    # whitespace, reading the text around the comment in growing windows
+    # until a gap with anything else is found in both directions
+    first = last = index
+    window = search_window
+    while True:
+        start = max(0, comments[index].begin() - window)
+        stop = min(view.size(), comments[index].end() + window)
+        text = view.substr(sublime.Region(start, stop))
+
+        def adjacent(first, second):
+            gap = text[first.end() - start:second.begin() - start]
+            return not gap or gap.isspace()
+
+        while (first > 0 and comments[first - 1].end() >= start
+               and adjacent(comments[first - 1], comments[first])):
+            first -= 1
+
+        while (last < len(comments) - 1
+               and comments[last + 1].begin() <= stop
+               and adjacent(comments[last], comments[last + 1])):
+            last += 1
+
+        # stop unless a gap reaches beyond the window
+        if ((first == 0 or comments[first - 1].end() >= start)
+                and (last == len(comments) - 1
+                     or comments[last + 1].begin() <= stop)):
+            break
+
+        window *= 2
+
+    # read all lines of these comments
+    area = view.line(sublime.Region(comments[first].begin(),
+                                    comments[last].end() - 1))
+    text = view.substr(area)
+
+    # find the lines in the text and the comment at the end of each of them
+    lines = []
+    offset = area.begin()
+    for line in text.split("\n"):
+        begin, end = offset, offset + len(line)
+        i = bisect_right(begins, end - 1) - 1
+        if begin < end and i >= 0 and comments[i].end() >= end:
+            comment = (comments[i].begin() - area.begin(),
+                       comments[i].end() - area.begin())
+        else:
+            comment = None
+
+        lines.append(((begin - area.begin(), end - area.begin()), comment))
+        offset = end + 1
+
+    # find the current line
+    row = text.count("\n", 0, pos - area.begin())
 
     # find the start of the comments by checking the lines above
     begin = -1
     for l in range(row, -1, -1):
-        line = view.line(view.text_point(l, 0))
-        if not is_valid_line_comment(view, line):
+        line, comment = lines[l]
+        if not is_valid_line_comment(text, line, comment):
             break
 
-        begin = line.begin()
+        begin = area.begin() + line[0]
 
     if begin == -1:
         # the comment at pos is invalid
@@ -50,17 +115,66 @@ def extract_line_comment_scope(view, pos):
 
     # find the end of the comments by checking the lines below
     end = pos
-    for l in range(row + 1, max_rows + 1):
-        line = view.line(view.text_point(l, 0))
-        if not is_valid_line_comment(view, line):
+    for l in range(row + 1, len(lines)):
+        line, comment = lines[l]
+        if not is_valid_line_comment(text, line, comment):
             break
 
-        end = line.end()
+        end = area.begin() + line[1]
 
     # return the region for all comment lines
     return view.full_line(sublime.Region(begin, end))
 
 
+def extract_line_comment_scopes(view):
+    """Return the scopes of all adjacent line comments in the view."""
+
+    comments = view.find_by_selector("comment.line")
+    if not comments:
+        return []
+
+    # read the whole view at once
+    text = view.substr(sublime.Region(0, view.size()))
+
+    # walk the lines ending in each comment, starting a new scope whenever a
+    # valid comment line doesn't follow the last one directly
+    scopes = []
+    scope = None
+    for c in comments:
+        begin = text.rfind("\n", 0, c.begin()) + 1
+        while begin < c.end():
+            end = text.find("\n", begin)
+            if end == -1:
+                end = len(text)
+            if end > c.end():
+                # the rest of the line is not part of the comment
+                break
+
+            comment = (c.begin(), c.end()) if end > c.begin() else None
+            if is_valid_line_comment(text, (begin, end), comment):
+                if scope and scope[1] + 1 == begin:
+                    scope[1] = end
+                else:
+                    scope = [begin, end]
+                    scopes.append(scope)
+
+            begin = end + 1
+
+    # return the regions for all comment lines
+    return [sublime.Region(begin, min(end + 1, len(text)))
+            for begin, end in scopes]
+
+
+def format_line_comment(view, comment):
+    """Return the formatted line comment."""
+
+    # get the parser for the view's settings
+    parser = get_parser(LineComment, view)
+
+    # format the comment nicely, or take it from the recently formatted ones
+    return format_text(parser, comment, LineComment)
+
+
 def FormatLineComment(view, edit, pos):
     """Format a line comment."""
     if not view.match_selector(pos, "comment.line"):
@@ -73,25 +187,7 @@ def FormatLineComment(view, edit, pos):
 
     comment = view.substr(scope)
 
-    # initialize the parser
-    parser = Parser()
-    parser.text = comment
-    parser.whitespace = re.compile(r"\0")  # disable automatic removal
-    parser.autoblank = False
-
-    # custom parameters for the compose methods
-    rulers = view.settings().get("rulers", [])
-
-    parser.width = (rulers and rulers[0]) or 80
-    parser.tab_size = view.settings().get("tab_size")
-
-    # try to parse the original comment
-    t, c = parser.parse(comment, LineComment)
-    if t:
-        raise parser.last_error
-
-    # format the comment nicely
-    formatted_comment = parser.compose(c)
+    formatted_comment = format_line_comment(view, comment)
 
     # update the view
     if formatted_comment != comment:
@@ -1,7 +1,6 @@
 """Grammar for line comments."""
 
 import re
-import textwrap
 
 from ..dependencies.pypeg2 import (
     Concat,
@@ -12,6 +11,8 @@ from ..dependencies.pypeg2 import (
     omit,
     some
 )
+from ..common.columns import columns
+from ..common.wrap import wrap
 
 Indentation = re.compile(r"[ \t]*")
 Punctuation = re.compile(r"//+|#+")
@@ -40,20 +41,18 @@ class ContiguousParagraph(List):
     def compose(self, parser, attr_of=None):
         # find the original line prefix and its length in characters
         prefix = parser.compose(self[0].prefix)
-        prefix_length = len(prefix.expandtabs(parser.tab_size))
+        prefix_length = columns(prefix, parser.tab_size)
 
         # add the contents of all lines together
         contents = " ".join([l.contents.strip() for l in self if l.contents])
 
         # wrap the text at the remaining width
         width = parser.width - prefix_length
-        lines = textwrap.wrap(contents, width, break_on_hyphens=False)
+        lines = wrap(contents, width, optimal=parser.optimal_wrapping)
 
-        # prepend the prefix to all lines
-        for i in range(0, len(lines)):
-            lines[i] = prefix + lines[i] + "\n"
-
-        return "".join(lines)
+        # write all lines with the prefix
+        for line in lines:
+            parser.write(prefix, line, "\n")
 
 
 class Paragraph(ContiguousParagraph):
@@ -0,0 +1,73 @@
+"""Preconfigured parsers shared by the formatters."""
+
+import threading
+from functools import lru_cache
+
+from ..dependencies.pypeg2 import Parser
+
+parsers = {}
+parsers_lock = threading.Lock()
+
+
+def get_parser(grammar, view):
+    """
+    Return the parser for grammar with the settings of view.
+
+    The line width is taken from the first ruler, the tab size from the
+    tab_size setting and paragraphs are balanced instead of being filled
+    greedily if the formatter_wrapping setting is "optimal".
+
+    Parsers keep the state of parsing and composing separate for every call,
+    so the same parser can be used by the main thread and worker threads at
+    once.
+    """
+
+    settings = view.settings()
+    rulers = settings.get("rulers", [])
+    width = (rulers and rulers[0]) or 80
+    tab_size = settings.get("tab_size")
+    optimal_wrapping = settings.get("formatter_wrapping") == "optimal"
+
+    key = (grammar, width, tab_size, optimal_wrapping)
+    with parsers_lock:
+        try:
+            return parsers[key]
+        except KeyError:
+            pass
+
+        # keep all whitespace as it is part of the formatting
+        parser = Parser(whitespace=None, autoblank=False)
+
+        # custom parameters for the compose methods
+        parser.width = width
+        parser.tab_size = tab_size
+        parser.optimal_wrapping = optimal_wrapping
+
+        parsers[key] = parser
+        return parser
+
+
+@lru_cache(maxsize=1024)
+def format_text(parser, text, grammar):
+    """
+    Return text parsed with grammar and composed again by parser.
+
+    Raises the parser's last error if text cannot be parsed and ValueError if
+    nothing was composed for it, so text is never replaced by nothing.
+
+    The results for the most recently formatted texts are kept, keyed by the
+    parser which stands for the grammar and the settings it was created
+    with. Most texts are already formatted and are kept along with their
+    result being the same text, so formatting them again only takes a
+    lookup. Errors are not kept and are raised again every time.
+    """
+
+    t, c = parser.parse(text, grammar)
+    if t:
+        raise parser.last_error
+
+    formatted = parser.compose(c)
+    if text and not formatted:
+        raise ValueError("nothing was composed for %r" % text)
+
+    return formatted
@@ -0,0 +1,286 @@
+"""Word wrapping shared by the formatters."""
+
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
+from sys import maxsize
+
+from .columns import columns, fitting, is_narrow
+
+# the whitespace textwrap breaks lines at, all of it is turned into spaces
+whitespace = "\t\n\x0b\x0c\r "
+spaces = str.maketrans(whitespace, " " * len(whitespace))
+chunks_regex = re.compile(r"( +)")
+
+
+@lru_cache(maxsize=4096)
+def wrap(text, width, initial_indent="", subsequent_indent="", tab_size=8,
+         break_long_words=True, optimal=False):
+    """
+    Wrap text into lines of at most width columns.
+
+    The lines are the same that textwrap.wrap returns with hyphens not being
+    broken as long as the indentation leaves room on the lines and every
+    character takes one column. Tabs in the indentation advance to the next
+    multiple of tab_size.
+
+    If optimal is set the lines are balanced instead of being filled one
+    after another, see wrap_optimal.
+
+    The lines of the most recently wrapped texts are kept and returned again
+    as a tuple when the same text is wrapped with the same arguments. How
+    often that happened is counted by wrap.cache_info().
+    """
+
+    if width <= 0:
+        raise ValueError("invalid width %r (must be > 0)" % width)
+
+    widths = (width - columns(initial_indent, tab_size),
+              width - columns(subsequent_indent, tab_size))
+    indents = (initial_indent, subsequent_indent)
+    narrow = is_narrow(text)
+
+    if optimal:
+        words = text.expandtabs().translate(spaces).split(" ")
+        words = [w for w in words if w]
+        return tuple(wrap_optimal(words, widths, indents, break_long_words,
+                                  narrow))
+
+    # most paragraphs are words separated by single spaces which can be
+    # wrapped by only searching for the spaces at the end of the lines
+    if (narrow and text.isprintable() and "  " not in text
+            and not text.startswith(" ") and not text.endswith(" ")
+            and min(widths) > 0):
+        return tuple(wrap_words(text, widths, indents, break_long_words))
+
+    if "\t" in text:
+        text = text.expandtabs()
+    text = text.translate(spaces)
+    if narrow:
+        return tuple(wrap_chunks(text, widths, indents, break_long_words))
+    return tuple(wrap_wide(text, widths, indents, break_long_words))
+
+
+def wrap_words(text, widths, indents, break_long_words):
+    """Wrap words separated by single spaces."""
+
+    length = len(text)
+    lines = []
+    start = 0
+    while start < length:
+        if lines:
+            # drop the space at the beginning of the line
+            if text[start] == " ":
+                start += 1
+            line_width = widths[1]
+        else:
+            line_width = widths[0]
+
+        limit = start + line_width
+        if limit >= length:
+            # the rest of the text fits on the line
+            end = next_start = length
+        elif text[limit] == " ":
+            # the line is filled up to the last character
+            end = next_start = limit
+        else:
+            # the line ends before the word which does not fit anymore
+            space = text.rfind(" ", start, limit)
+            word_end = text.find(" ", limit)
+            if word_end < 0:
+                word_end = length
+
+            if word_end - space - 1 <= line_width:
+                end, next_start = space, space + 1
+            elif break_long_words:
+                # fill the line with the beginning of the long word
+                end = next_start = limit
+            elif space < 0:
+                # the long word gets a line of its own
+                end = next_start = word_end
+            else:
+                end, next_start = space, space + 1
+
+        lines.append(indents[len(lines) > 0] + text[start:end])
+        start = next_start
+
+    return lines
+
+
+def wrap_chunks(text, widths, indents, break_long_words):
+    """Wrap words and runs of spaces the way textwrap does."""
+
+    length = len(text)
+
+    # the end offset of every word and run of spaces in the text
+    ends = list(accumulate(map(len, filter(None, chunks_regex.split(text)))))
+
+    lines = []
+    start = 0
+    while start < length:
+        if lines:
+            # drop whitespace at the beginning of the line
+            end = ends[bisect_right(ends, start)]
+            if not text[start:end].strip():
+                start = end
+                if start == length:
+                    break
+            line_width = widths[1]
+        else:
+            line_width = widths[0]
+
+        # take as many chunks as fit on the line
+        i = bisect_right(ends, start + max(line_width, 0))
+        end = ends[i - 1] if i and ends[i - 1] > start else start
+        last = max(start, ends[i - 2]) if i > 1 else start
+        next_start = end
+
+        # the next chunk is too long to fit on any line
+        if end < length and ends[i] - end > line_width:
+            if break_long_words:
+                if line_width < 1:
+                    next_start = end + 1
+                else:
+                    next_start = start + line_width
+                last = end
+                end = next_start
+            elif end == start:
+                end = next_start = ends[i]
+
+        # drop whitespace at the end of the line
+        if not text[last:end].strip():
+            end = last
+
+        if end > start:
+            lines.append(indents[len(lines) > 0] + text[start:end])
+
+        start = next_start
+
+    return lines
+
+
+def wrap_wide(text, widths, indents, break_long_words):
+    """Wrap text with characters taking more or less than one column."""
+
+    chunks = [chunk for chunk in chunks_regex.split(text) if chunk]
+    chunks.reverse()
+
+    lines = []
+    while chunks:
+        line = []
+        line_length = 0
+        line_width = widths[len(lines) > 0]
+
+        # drop whitespace at the beginning of all but the first line
+        if lines and not chunks[-1].strip():
+            del chunks[-1]
+
+        # take as many chunks as fit on the line
+        while chunks:
+            length = columns(chunks[-1])
+            if line_length + length > line_width:
+                break
+
+            line.append(chunks.pop())
+            line_length += length
+
+        # the next chunk is too long to fit on any line
+        if chunks and columns(chunks[-1]) > line_width:
+            if break_long_words:
+                chunk = chunks[-1]
+                end = fitting(chunk, line_width - line_length)
+                if not end and not line:
+                    # take at least one character to get any further
+                    end = 1
+                if end:
+                    line.append(chunk[:end])
+                    chunks[-1] = chunk[end:]
+            elif not line:
+                line.append(chunks.pop())
+
+        # drop whitespace at the end of the line
+        if line and not line[-1].strip():
+            del line[-1]
+
+        if line:
+            lines.append(indents[len(lines) > 0] + "".join(line))
+
+    return lines
+
+
+def wrap_optimal(words, widths, indents, break_long_words=True,
+                 narrow=True):
+    """
+    Wrap words with the least raggedness.
+
+    The lines are chosen to minimize the sum of the squared space left at
+    the end of all but the last line. Only as many words as fit on a line
+    are looked back at for every break, so the time grows linearly with the
+    number of words. Words are separated by single spaces. Words longer than
+    a line are broken into pieces filling whole lines if break_long_words is
+    set, otherwise they get a line of their own.
+    """
+
+    if break_long_words:
+        words = list(split_long_words(words, max(min(widths), 1), narrow))
+
+    count = len(words)
+
+    # offsets[i] is the length of the first i words with a space after each
+    offsets = [0]
+    if narrow:
+        offsets.extend(accumulate(len(w) + 1 for w in words))
+    else:
+        offsets.extend(accumulate(columns(w) + 1 for w in words))
+
+    # the least cost of breaking the text before every word and the start
+    # of the line ending there
+    costs = [0] + [maxsize] * count
+    starts = [0] * (count + 1)
+    for end in range(1, count + 1):
+        start = end - 1
+        while start >= 0:
+            line_width = widths[start > 0]
+            slack = line_width - (offsets[end] - offsets[start] - 1)
+            if slack < 0 and start < end - 1:
+                if start > 0:
+                    # only the first line can still fit if it is wider
+                    start = 0
+                    continue
+                break
+
+            if end == count or slack < 0:
+                cost = costs[start]
+            else:
+                cost = costs[start] + slack * slack
+            if cost < costs[end]:
+                costs[end] = cost
+                starts[end] = start
+
+            start -= 1
+
+    # follow the breaks back from the end of the text
+    breaks = []
+    end = count
+    while end > 0:
+        breaks.append((starts[end], end))
+        end = starts[end]
+
+    lines = []
+    for start, end in reversed(breaks):
+        lines.append(indents[start > 0] + " ".join(words[start:end]))
+    return lines
+
+
+def split_long_words(words, width, narrow=True):
+    """Split words longer than width columns into pieces of whole lines."""
+
+    for word in words:
+        while (len(word) if narrow else columns(word)) > width:
+            # take at least one character to get any further
+            end = max(1, fitting(word, width))
+            yield word[:end]
+            word = word[end:]
+
+        yield word
@@ -34,6 +34,12 @@ if __debug__:
     import warnings
 from types import FunctionType
 from collections import namedtuple
+from bisect import bisect_right
+from threading import RLock, local
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 try:
     from collections import OrderedDict
 except ImportError:
@@ -497,6 +503,50 @@ class Concat(List):
     """
 
 
+class Lines(object):
+    """Classification of the lines of a text, which is done once per parse.
+
+    Instance variables:
+        regex       regular expression which is matched at the start of every
+                    line; the name of the group which matched is the kind of
+                    the line, None if it does not match
+    """
+
+    def __init__(self, regex):
+        self.regex = regex
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + repr(self.regex) + ")"
+
+    def classify(self, text, start):
+        """Return the kind of the line starting at offset start of text."""
+        m = self.regex.match(text, start)
+        if m:
+            return m.lastgroup
+        return None
+
+    def kind(self, *kinds):
+        """Generate a grammar element matching nothing, but only in lines of
+        one of kinds."""
+        return LineKind(self, kinds)
+
+
+class LineKind(object):
+    """Matches nothing in lines of the given kinds and fails in all others.
+
+    Instance variables:
+        lines       Lines which classify the lines of the text
+        kinds       tuple of accepted kinds of lines
+    """
+
+    def __init__(self, lines, kinds):
+        self.lines = lines
+        self.kinds = kinds
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + repr(self.kinds) + ")"
+
+
 def name():
     """Generate a grammar for a symbol with name."""
     return attr("name", Symbol)
@@ -537,6 +587,25 @@ def omit(*thing):
     return _card(-6, thing)
 
 
+_memoized = {}
+
+
+def memoize(thing, enabled=True):
+    """Declare if the results of parsing thing are kept in the packrat
+    memory. Grammar classes can declare this with a memoize attribute
+    instead.
+
+    By default, only grammar rules which can be tried at the same position
+    by more than one option of an ordered choice are kept.
+
+    Returns:
+        thing
+    """
+
+    _memoized[id(thing)] = thing, enabled
+    return thing
+
+
 endl = lambda thing, parser: "\n"
 """End of line marker for composing text."""
 
@@ -556,9 +625,42 @@ class GrammarValueError(ValueError, GrammarError):
     """Raised if grammar contains an illegal value."""
 
 
+_Failure = namedtuple("Failure", ("offset", "thing", "detail"))
+"""Cheap record of a failed parse of thing at offset. A SyntaxError is only
+generated from it when needed."""
+
+
+def _error_message(thing, detail):
+    # Describe the failure of parsing thing for a syntax error
+    if isinstance(thing, (tuple, Concat)):
+        _min, e, found = detail
+        return ("expecting " + str(_min) + " occurrence(s) of " + repr(e)
+                + " (" + str(found) + " found)")
+    elif isinstance(thing, list):
+        return "expecting one of " + repr(thing)
+    elif isinstance(thing, Symbol):
+        return "expecting " + repr(thing)
+    elif isinstance(thing, (RegEx, _RegEx)):
+        return "expecting match on " + thing.pattern
+    elif isinstance(thing, (str, Literal)):
+        return "expecting " + repr(thing)
+    elif isinstance(thing, LineKind):
+        return "expecting a line of kind " + " or ".join(map(str, thing.kinds))
+    elif detail is not None:
+        return repr(detail) + " is not a member of " + repr(thing.grammar)
+    else:
+        return "expecting " + thing.__name__
+
+
+_cardinalities = {}
+
+
 def how_many(grammar):
     """Determines the possibly parsed objects of grammar.
 
+    The result for tuples and lists is computed once and remembered, see
+    forget_grammars() for grammars which are changed at runtime.
+
     Returns:
         0 if there will be no objects
         1 if there will be a maximum of one object
@@ -571,6 +673,28 @@ def how_many(grammar):
                     if grammar contains an illegal cardinality value
     """
 
+    if not isinstance(grammar, (tuple, list)):
+        return _how_many(grammar)
+
+    # the grammar itself is kept in the entry, so its id cannot be reused by
+    # another object
+    try:
+        entry = _cardinalities[id(grammar)]
+    except KeyError:
+        pass
+    else:
+        if entry[0] is grammar:
+            return entry[1]
+
+    result = _how_many(grammar)
+    _cardinalities[id(grammar)] = grammar, result
+    return result
+
+
+def _how_many(grammar):
+    # Determine the possibly parsed objects of grammar without remembering
+    # the result
+
     if grammar is None:
         return 0
 
@@ -589,6 +713,9 @@ def how_many(grammar):
     elif type(grammar) == FunctionType:
         return 0
 
+    elif isinstance(grammar, LineKind):
+        return 0
+
     elif isinstance(grammar, (tuple, Concat)):
         length, card = 0, 1
         for e in grammar:
@@ -707,6 +834,994 @@ def _issubclass(obj, cls):
         return False
 
 
+def _looks_behind(pattern):
+    # Check if a parsed regular expression contains assertions depending on
+    # the text before the position where matching starts
+    for op, av in pattern:
+        if op == sre_parse.AT:
+            if av in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING,
+                    sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY):
+                return True
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT) and av[0] < 0:
+            return True
+        L = [av]
+        while L:
+            e = L.pop()
+            if isinstance(e, sre_parse.SubPattern):
+                if _looks_behind(e):
+                    return True
+            elif isinstance(e, (tuple, list)):
+                L.extend(e)
+    return False
+
+
+def _needs_rest(regex):
+    # Determine if regex has to be matched against the rest of the text
+    # instead of the whole text with a start position. This is the case for
+    # "^", "\A", "\b", "\B" and lookbehind assertions.
+    regex = getattr(regex, "regex", regex)
+    try:
+        return _needs_rest.cache[regex]
+    except KeyError:
+        pass
+    try:
+        result = _looks_behind(sre_parse.parse(regex.pattern, regex.flags))
+    except Exception:
+        result = True
+    _needs_rest.cache[regex] = result
+    return result
+
+_needs_rest.cache = {}
+
+
+_compiled = {}
+_compiling = RLock()
+
+
+def forget_grammars():
+    """Forget everything which was derived from grammars.
+
+    Grammars are compiled and their cardinalities are determined on first
+    use. After a grammar was changed at runtime, this function must be called
+    before parsing or composing with it again.
+    """
+
+    with _compiling:
+        _compiled.clear()
+        _cardinalities.clear()
+        _analysed.clear()
+        _shared.clear()
+
+
+def _compile(thing, track=True):
+    # Return a matcher for thing, compiling it on first use. A matcher is
+    # called as matcher(parser, offset) and returns (offset, result) just
+    # like Parser._parse(), but all decisions depending on the type of the
+    # grammar are made once here instead of on every call.
+    key = id(thing), track
+    entry = _compiled.get(key)
+    if (entry is not None and entry[3] and entry[0] is thing
+            and entry[1] is getattr(thing, "grammar", None)):
+        return entry[2]
+
+    # only one thread compiles at a time, so unfinished matchers found here
+    # belong to the grammar being compiled by this thread
+    with _compiling:
+        entry = _compiled.get(key)
+        if (entry is not None and entry[0] is thing
+                and entry[1] is getattr(thing, "grammar", None)):
+            return entry[2]
+
+        # recursive grammars refer to a matcher which is still being
+        # compiled
+        cell = []
+        def forward(parser, offset):
+            return cell[0](parser, offset)
+        _compiled[key] = thing, getattr(thing, "grammar", None), forward, False
+
+        try:
+            matcher = _compile_thing(thing, track)
+        except:
+            del _compiled[key]
+            raise
+        cell.append(matcher)
+        _compiled[key] = thing, getattr(thing, "grammar", None), matcher, True
+        return matcher
+
+
+def _compile_thing(thing, track):
+    # Compile the matcher for thing, following the order of Parser._parse()
+    try:
+        thing.parse
+    except AttributeError:
+        pass
+    else:
+        return _compile_custom(thing, track)
+
+    if thing is None or type(thing) == FunctionType:
+        def match_nothing(parser, offset):
+            return offset, None
+        matcher = match_nothing
+    elif isinstance(thing, Symbol):
+        matcher = _compile_symbol(thing)
+    elif isinstance(thing, (RegEx, _RegEx)):
+        matcher = _compile_regex(thing)
+    elif isinstance(thing, (str, Literal)):
+        matcher = _compile_literal(thing)
+    elif _issubclass(thing, Symbol):
+        matcher = _compile_symbol_class(thing)
+    elif isinstance(thing, attr.Class):
+        matcher = _compile_attr(thing, track)
+    elif isinstance(thing, LineKind):
+        return _compile_line_kind(thing)
+    elif isinstance(thing, (tuple, Concat)):
+        matcher = _compile_concat(thing, track)
+    elif isinstance(thing, list):
+        matcher = _compile_options(thing, track)
+    elif _issubclass(thing, Namespace):
+        matcher = _compile_namespace(thing, track)
+    elif _issubclass(thing, list):
+        matcher = _compile_list(thing, track)
+    elif _issubclass(thing, object):
+        matcher = _compile_object(thing, track)
+    else:
+        raise GrammarTypeError("in grammar: " + repr(thing))
+
+    return _compile_memory(thing, matcher, track)
+
+
+_plain_results = (type(None), str, list, attr.Class)
+
+
+def _compile_memory(thing, matcher, track):
+    # Wrap matcher to use the packrat memory if thing is memoized and to
+    # record failures and positions
+    key = id(thing)
+
+    def record(parser, offset, r):
+        if type(r) is _Failure:
+            # only remember the failure which got furthest
+            failure = parser._failure
+            if failure is None or r.offset >= failure.offset:
+                parser._failure = r
+                parser._last_error = None
+        elif type(r) not in _plain_results:
+            try:
+                r.position_in_text = parser._position(offset)
+            except AttributeError:
+                pass
+
+    if _memoizes(thing):
+        def match_memoized(parser, offset):
+            memory = parser._memory
+            try:
+                return memory[key][offset]
+            except KeyError:
+                pass
+
+            result = matcher(parser, offset)
+            if track:
+                record(parser, offset, result[1])
+
+            if parser._room:
+                parser._room -= 1
+                # the memory may have been forgotten meanwhile
+                memory = parser._memory
+                try:
+                    memory[key][offset] = result
+                except KeyError:
+                    memory[key] = { offset: result }
+            else:
+                parser._remember(key, offset, result)
+            return result
+        return match_memoized
+
+    if not track:
+        return matcher
+
+    def match_tracked(parser, offset):
+        result = matcher(parser, offset)
+        record(parser, offset, result[1])
+        return result
+    return match_tracked
+
+
+_analysed = {}
+_shared = {}
+
+
+def _memoizes(thing):
+    # Decide if the results of thing are kept in the packrat memory
+    try:
+        entry = _memoized[id(thing)]
+    except KeyError:
+        pass
+    else:
+        if entry[0] is thing:
+            return entry[1]
+    try:
+        return bool(thing.memoize)
+    except AttributeError:
+        pass
+
+    # matching terminals again is cheaper than looking them up
+    if isinstance(thing, attr.Class) or not (isinstance(thing, (tuple, list))
+                                             or _is_rule(thing)):
+        return False
+    # things which were not analysed are kept to be safe
+    if id(thing) not in _analysed:
+        return True
+    return id(thing) in _shared
+
+
+def _analyse(root):
+    # Find the grammar rules reachable from root which are tried more than
+    # once at the same position, because they can start more than one
+    # option of an ordered choice or are the anchor of options
+    if id(root) in _analysed:
+        return
+    with _compiling:
+        _analyse_locked(root)
+
+
+def _analyse_locked(root):
+    # Analyse root while no other thread compiles or analyses grammars
+    if id(root) in _analysed:
+        return
+
+    analysed, shared = {}, {}
+    todo = [root]
+    while todo:
+        thing = todo.pop()
+        if id(thing) in _analysed or id(thing) in analysed:
+            continue
+        analysed[id(thing)] = thing
+        if hasattr(thing, "parse"):
+            continue
+
+        if isinstance(thing, attr.Class):
+            todo.append(thing.thing)
+        elif isinstance(thing, (tuple, Concat)):
+            todo.extend(e for e in thing if type(e) != int)
+        elif isinstance(thing, list):
+            todo.extend(thing)
+            starting = {}
+            for e in thing:
+                for s in dict((id(s), s) for s in _starts(e)).values():
+                    if id(s) in starting:
+                        shared[id(s)] = s
+                    starting[id(s)] = s
+                for a in _anchors(e):
+                    shared[id(a)] = a
+        elif _is_rule(thing):
+            todo.append(_rule_grammar(thing))
+
+    # earlier analyses may have decided that some of these aren't kept
+    if any(key in _analysed and key not in _shared for key in shared):
+        _compiled.clear()
+    _analysed.update(analysed)
+    _shared.update(shared)
+
+
+def _starts(thing, seen=()):
+    # Return the grammar rules which can be tried at the position where a
+    # match of thing starts
+    if id(thing) in seen or hasattr(thing, "parse"):
+        return []
+    seen = seen + (id(thing),)
+
+    if isinstance(thing, attr.Class):
+        return _starts(thing.thing, seen)
+    elif isinstance(thing, (tuple, Concat)):
+        result = [thing]
+        for e, _min, _max in _steps(thing):
+            if e is None:
+                continue
+            result.extend(_starts(e, seen))
+            if _min > 0 and not _leads(e)[1]:
+                break
+        return result
+    elif isinstance(thing, list):
+        result = [thing]
+        for e in thing:
+            result.extend(_starts(e, seen))
+        return result
+    elif _is_rule(thing):
+        return [thing] + _starts(_rule_grammar(thing), seen)
+    return []
+
+
+def _compile_custom(thing, track):
+    def match_custom(parser, offset):
+        return parser._parse_custom(offset, thing, track)
+    return match_custom
+
+
+def _compile_symbol(thing):
+    regex = type(thing).regex
+    value = str(thing)
+    if _needs_rest(regex):
+        def match_symbol(parser, offset):
+            m = parser._match(regex, offset)
+            if m is not None and m == value:
+                t = offset + len(value)
+                if parser._skips:
+                    t = parser._skip(t)[0]
+                return t, None
+            return offset, _Failure(offset, thing, None)
+    else:
+        regex_match = getattr(regex, "regex", regex).match
+        def match_symbol(parser, offset):
+            m = regex_match(parser.text, offset)
+            if m and m.group(0) == value:
+                t = offset + len(value)
+                if parser._skips:
+                    t = parser._skip(t)[0]
+                return t, None
+            return offset, _Failure(offset, thing, None)
+    return match_symbol
+
+
+def _compile_regex(thing):
+    if _needs_rest(thing):
+        def match_regex(parser, offset):
+            m = parser._match(thing, offset)
+            if m is not None:
+                t = offset + len(m)
+                if parser._skips:
+                    t = parser._skip(t)[0]
+                return t, m
+            return offset, _Failure(offset, thing, None)
+    else:
+        regex_match = getattr(thing, "regex", thing).match
+        def match_regex(parser, offset):
+            m = regex_match(parser.text, offset)
+            if m:
+                m = m.group(0)
+                t = offset + len(m)
+                if parser._skips:
+                    t = parser._skip(t)[0]
+                return t, m
+            return offset, _Failure(offset, thing, None)
+    return match_regex
+
+
+def _compile_literal(thing):
+    value = str(thing)
+    length = len(value)
+
+    def match_literal(parser, offset):
+        if parser.text.startswith(value, offset):
+            t = offset + length
+            if parser._skips:
+                t = parser._skip(t)[0]
+            return t, None
+        return offset, _Failure(offset, thing, None)
+    return match_literal
+
+
+def _compile_line_kind(thing):
+    lines, kinds = thing.lines, thing.kinds
+
+    def match_line_kind(parser, offset):
+        if parser._line_kind(lines, offset) in kinds:
+            return offset, None
+        return offset, _Failure(offset, thing, None)
+    return match_line_kind
+
+
+def _compile_symbol_class(thing):
+    try:
+        grammar = thing.grammar
+    except AttributeError:
+        grammar = None
+    if grammar is not None and not isinstance(grammar, Enum):
+        raise GrammarValueError(
+                "Symbol " + type(thing).__name__
+                + " has a grammar which is not an Enum: " + repr(grammar))
+
+    regex = thing.regex
+
+    def match_symbol_class(parser, offset):
+        m = parser._match(regex, offset)
+        if m is None:
+            return offset, _Failure(offset, thing, None)
+        if grammar is not None and not m in grammar:
+            return offset, _Failure(offset, thing, m)
+        t = offset + len(m)
+        if parser._skips:
+            t = parser._skip(t)[0]
+        return t, thing(m)
+    return match_symbol_class
+
+
+def _compile_attr(thing, track):
+    name = thing.name
+    matcher = _compile(thing.thing, track)
+
+    if thing.subtype == "Flag":
+        def match_flag(parser, offset):
+            t, r = matcher(parser, offset)
+            if type(r) is _Failure:
+                return t, attr(name, False)
+            return t, attr(name, True)
+        return match_flag
+
+    def match_attr(parser, offset):
+        t, r = matcher(parser, offset)
+        if type(r) is _Failure:
+            return offset, r
+        return t, attr(name, r)
+    return match_attr
+
+
+def _compile_concat(thing, track):
+    # resolve the cardinalities into steps of (matcher, element, minimum,
+    # maximum, omit) and markers for changing the whitespace handling
+    steps = []
+    _min, _max = 1, 1
+    omit = False
+    for e in thing:
+        if type(e) == int:
+            if e < -6:
+                raise GrammarValueError(
+                    "illegal cardinality value in grammar: " + str(e))
+            if e == -6:
+                omit = True
+            elif e in (-5, -4):
+                steps.append(e)
+            elif e == -3:
+                pass
+            elif e == -2:
+                _min, _max = 1, maxsize
+            elif e == -1:
+                _min, _max = 0, maxsize
+            elif e ==  0:
+                _min, _max = 0, 1
+            else:
+                _min, _max = e, e
+            continue
+        steps.append((_compile(e, track), e, _min, _max, omit))
+        _min, _max = 1, 1
+        omit = False
+
+    multiple = how_many(thing) > 1
+
+    def match_concat(parser, offset):
+        L = []
+        t = offset
+        contiguous = parser._contiguous
+        try:
+            for step in steps:
+                if step == -5:
+                    parser._contiguous = False
+                    if parser._skips:
+                        t = parser._skip(t)[0]
+                    continue
+                elif step == -4:
+                    parser._contiguous = True
+                    continue
+
+                matcher, e, _min, _max, omit = step
+                found = 0
+                r = None
+                while found < _max:
+                    t2, r = matcher(parser, t)
+                    if type(r) is _Failure:
+                        break
+                    found += 1
+                    if not omit and r is not None:
+                        if type(r) is list:
+                            L.extend(r)
+                        else:
+                            L.append(r)
+                    if t2 == t and _max == maxsize:
+                        # an empty match would be repeated forever
+                        break
+                    t = t2
+                if found < _min:
+                    if type(r) is not _Failure:
+                        r = _Failure(t, thing, (_min, e, found))
+                    return offset, r
+
+            if parser._contiguous and not contiguous:
+                parser._contiguous = False
+                if parser._skips:
+                    t = parser._skip(t)[0]
+        finally:
+            parser._contiguous = contiguous
+
+        if len(L) > 1 or multiple:
+            return t, L
+        elif not L:
+            return t, None
+        else:
+            return t, L[0]
+    return match_concat
+
+
+def _compile_options(thing, track):
+    matchers = [_compile(e, track) for e in thing]
+
+    # only try the options which can start with what follows
+    groups = _dispatch_groups(thing, track)
+    if groups is None:
+        options = matchers
+    else:
+        options = None
+
+    def match_options(parser, offset):
+        if groups is None:
+            viable = options
+        else:
+            viable = [matchers[i] for i in
+                      _viable_options(parser, offset, groups)]
+        for matcher in viable:
+            try:
+                t, r = matcher(parser, offset)
+            except GrammarValueError:
+                raise
+            except ValueError:
+                continue
+            if type(r) is not _Failure:
+                return t, r
+        return offset, _Failure(offset, thing, None)
+    return match_options
+
+
+def _compile_namespace(thing, track):
+    matcher = _compile(thing.grammar, track)
+
+    def match_namespace(parser, offset):
+        t, r = matcher(parser, offset)
+        if type(r) is _Failure:
+            return offset, r
+        if isinstance(r, thing):
+            return t, r
+
+        obj = thing()
+        for e in r:
+            if type(e) == attr.Class:
+                setattr(obj, e.name, e.thing)
+            else:
+                try:
+                    obj[e.name] = e
+                except AttributeError:
+                    obj[None] = e
+
+        try:
+            obj.polish()
+        except AttributeError:
+            pass
+        return t, obj
+    return match_namespace
+
+
+def _compile_list(thing, track):
+    try:
+        g = thing.grammar
+    except AttributeError:
+        g = csl(Symbol)
+    matcher = _compile(g, track)
+
+    def match_list(parser, offset):
+        t, r = matcher(parser, offset)
+        if type(r) is _Failure:
+            return offset, r
+        if isinstance(r, thing):
+            return t, r
+
+        obj = thing()
+        if type(r) == list:
+            for e in r:
+                if type(e) == attr.Class:
+                    setattr(obj, e.name, e.thing)
+                else:
+                    obj.append(e)
+        else:
+            if type(r) == attr.Class:
+                setattr(obj, r.name, r.thing)
+            else:
+                obj.append(r)
+
+        try:
+            obj.polish()
+        except AttributeError:
+            pass
+        return t, obj
+    return match_list
+
+
+def _compile_object(thing, track):
+    try:
+        g = thing.grammar
+    except AttributeError:
+        g = word
+        lg = None
+    else:
+        lg = how_many(g)
+    matcher = _compile(g, track)
+
+    def match_object(parser, offset):
+        t, r = matcher(parser, offset)
+        if type(r) is _Failure:
+            return offset, r
+        if isinstance(r, thing):
+            return t, r
+
+        try:
+            if type(r) == list:
+                L, a = [], []
+                for e in r:
+                    if type(e) == attr.Class:
+                        a.append(e)
+                    else:
+                        L.append(e)
+                if L:
+                    if lg == 0:
+                        obj = None
+                    elif lg == 1:
+                        obj = thing(L[0])
+                    else:
+                        obj = thing(L)
+                else:
+                    obj = thing()
+                for e in a:
+                    setattr(obj, e.name, e.thing)
+            else:
+                if type(r) == attr.Class:
+                    obj = thing()
+                    setattr(obj, r.name, r.thing)
+                else:
+                    if r is None:
+                        obj = thing()
+                    else:
+                        obj = thing(r)
+        except TypeError as e:
+            L = list(e.args)
+            L[0] = thing.__name__ + ": " + L[0]
+            e.args = tuple(L)
+            raise e
+
+        try:
+            obj.polish()
+        except AttributeError:
+            pass
+        return t, obj
+    return match_object
+
+
+def _regex_leads(regex):
+    # Determine the characters a match of regex can start with as
+    # (leads, nullable), see _leads()
+    regex = getattr(regex, "regex", regex)
+    try:
+        return _regex_leads.cache[regex]
+    except KeyError:
+        pass
+    if regex.flags & re.IGNORECASE:
+        result = None, True
+    else:
+        try:
+            result = _pattern_leads(sre_parse.parse(regex.pattern,
+                                                    regex.flags))
+        except Exception:
+            result = None, True
+    _regex_leads.cache[regex] = result
+    return result
+
+_regex_leads.cache = {}
+
+
+def _pattern_leads(pattern):
+    # Leads of a sequence of parsed regular expression items
+    leads = set()
+    for op, av in pattern:
+        if op == sre_parse.LITERAL:
+            l, n = set([chr(av)]), False
+        elif op == sre_parse.IN:
+            l, n = set(), False
+            for o, a in av:
+                if o == sre_parse.LITERAL:
+                    l.add(chr(a))
+                elif o == sre_parse.RANGE and a[1] - a[0] < 256:
+                    l.update(chr(c) for c in range(a[0], a[1] + 1))
+                else:
+                    return None, True
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                getattr(sre_parse, "POSSESSIVE_REPEAT", None)):
+            l, n = _pattern_leads(av[2])
+            n = n or av[0] == 0
+        elif op == sre_parse.SUBPATTERN:
+            if len(av) > 2 and av[1] & re.IGNORECASE:
+                return None, True
+            l, n = _pattern_leads(av[-1])
+        elif op == getattr(sre_parse, "ATOMIC_GROUP", None):
+            l, n = _pattern_leads(av)
+        elif op == sre_parse.BRANCH:
+            l, n = set(), False
+            for p in av[1]:
+                bl, bn = _pattern_leads(p)
+                if bl is None:
+                    return None, True
+                l |= bl
+                n = n or bn
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            # assertions can only restrict a match
+            l, n = set(), True
+        else:
+            return None, True
+        if l is None:
+            return None, True
+        leads |= l
+        if not n:
+            return leads, False
+    return leads, True
+
+
+def _is_rule(thing):
+    # Check if thing is a grammar class which is parsed using its grammar
+    return (isinstance(thing, type) and not _issubclass(thing, Symbol)
+            and not hasattr(thing, "parse"))
+
+
+def _rule_grammar(thing):
+    # Return the grammar used for parsing the rule thing
+    try:
+        return thing.grammar
+    except AttributeError:
+        if _issubclass(thing, list) and not _issubclass(thing, Namespace):
+            return csl(Symbol)
+        return word
+
+
+def _steps(thing):
+    # Iterate over the elements of a concatenation as (element, minimum,
+    # maximum), with None for elements that change the whitespace handling
+    _min, _max = 1, 1
+    for e in thing:
+        if type(e) == int:
+            if e in (-5, -4):
+                yield None, 0, 0
+            elif e == -2:
+                _min, _max = 1, maxsize
+            elif e == -1:
+                _min, _max = 0, maxsize
+            elif e == 0:
+                _min, _max = 0, 1
+            elif e > 0:
+                _min, _max = e, e
+            continue
+        yield e, _min, _max
+        _min, _max = 1, 1
+
+
+def _leads(thing, seen=()):
+    # Determine how a match of thing starts. Returns (leads, nullable,
+    # sensitive) with:
+    #   leads       set of strings of which every non-empty match starts
+    #               with one, None if this is unknown
+    #   nullable    if thing can match the empty string
+    #   sensitive   if an empty match of a terminal can be followed by
+    #               skipped whitespace or comments
+    if hasattr(thing, "parse") or id(thing) in seen:
+        return None, True, True
+    seen = seen + (id(thing),)
+
+    if thing is None or type(thing) == FunctionType:
+        return set(), True, False
+    elif isinstance(thing, Symbol):
+        return set([str(thing)]), not str(thing), not str(thing)
+    elif isinstance(thing, (RegEx, _RegEx)):
+        leads, nullable = _regex_leads(thing)
+        return leads, nullable, nullable
+    elif isinstance(thing, (str, Literal)):
+        return set([str(thing)]), not str(thing), not str(thing)
+    elif _issubclass(thing, Symbol):
+        leads, nullable = _regex_leads(thing.regex)
+        return leads, nullable, nullable
+    elif isinstance(thing, attr.Class):
+        leads, nullable, sensitive = _leads(thing.thing, seen)
+        return leads, nullable or thing.subtype == "Flag", sensitive
+    elif isinstance(thing, LineKind):
+        return set(), True, False
+    elif isinstance(thing, (tuple, Concat)):
+        return _leads_steps(list(_steps(thing)), seen)
+    elif isinstance(thing, list):
+        leads, nullable, sensitive = set(), False, False
+        for e in thing:
+            l, n, s = _leads(e, seen)
+            if l is None:
+                return None, True, True
+            leads |= l
+            nullable = nullable or n
+            sensitive = sensitive or s
+        return leads, nullable, sensitive
+    elif _is_rule(thing):
+        return _leads(_rule_grammar(thing), seen)
+    else:
+        return None, True, True
+
+
+def _leads_steps(steps, seen):
+    # Leads of a sequence of steps from _steps()
+    leads, sensitive = set(), False
+    for e, _min, _max in steps:
+        if e is None:
+            return None, True, True
+        l, n, s = _leads(e, seen)
+        if l is None:
+            return None, True, True
+        leads |= l
+        sensitive = sensitive or s
+        if not n and _min > 0:
+            return leads, False, sensitive
+    return leads, True, sensitive
+
+
+def _leftmost(thing):
+    # Return the steps of the concatenation thing if every match of it
+    # starts with its first element, None otherwise
+    steps = list(_steps(thing))
+    if steps and steps[0][0] is not None and steps[0][1] > 0:
+        return steps
+    return None
+
+
+def _anchors(thing, seen=()):
+    # Return the list of grammar rules every match of thing starts with,
+    # from the outermost to the innermost one
+    if id(thing) in seen:
+        return []
+    seen = seen + (id(thing),)
+
+    if isinstance(thing, attr.Class):
+        # flags match even if their thing does not
+        if thing.subtype != "Flag":
+            return _anchors(thing.thing, seen)
+    elif isinstance(thing, (tuple, Concat)):
+        steps = _leftmost(thing)
+        if steps:
+            return _anchors(steps[0][0], seen)
+    elif isinstance(thing, list):
+        if thing:
+            L = [_anchors(e, seen) for e in thing]
+            return [a for a in L[0] if all(a in l for l in L[1:])]
+    elif _is_rule(thing):
+        return [thing] + _anchors(_rule_grammar(thing), seen)
+    return []
+
+
+def _after(thing, anchor, seen=()):
+    # Determine how the rest of a match of thing continues after the anchor
+    # it starts with. Returns (leads, nullable, sensitive) like _leads().
+    if thing is anchor:
+        return set(), True, False
+    if id(thing) in seen:
+        return None, True, True
+    seen = seen + (id(thing),)
+
+    if isinstance(thing, attr.Class):
+        return _after(thing.thing, anchor, seen)
+    elif isinstance(thing, (tuple, Concat)):
+        steps = _leftmost(thing)
+        e, _min, _max = steps[0]
+        leads, nullable, sensitive = _after(e, anchor, seen)
+        if leads is None:
+            return None, True, True
+        if nullable and _max > 1:
+            # the element can be repeated after it ended
+            l, n, s = _leads(e)
+            if l is None:
+                return None, True, True
+            leads |= l
+            sensitive = sensitive or s
+        if nullable:
+            l, nullable, s = _leads_steps(steps[1:], ())
+            if l is None:
+                return None, True, True
+            leads |= l
+            sensitive = sensitive or s
+        return leads, nullable, sensitive
+    elif isinstance(thing, list):
+        leads, nullable, sensitive = set(), False, False
+        for e in thing:
+            l, n, s = _after(e, anchor, seen)
+            if l is None:
+                return None, True, True
+            leads |= l
+            nullable = nullable or n
+            sensitive = sensitive or s
+        return leads, nullable, sensitive
+    elif _is_rule(thing):
+        return _after(_rule_grammar(thing), anchor, seen)
+    else:
+        return None, True, True
+
+
+def _dispatch_groups(thing, track):
+    # Build the tables for choosing the viable options of thing from what
+    # follows at the current position. Options are grouped by the grammar
+    # rule they start with (their anchor), which is parsed once for all of
+    # them. Returns a list of (anchor matcher or None, table, default,
+    # indices) with:
+    #   table       dict mapping the next character to a list of options
+    #               as (index, leads, sensitive)
+    #   default     list of options for all other characters
+    #   indices     indices of all options in the group
+    groups = OrderedDict()
+    for i, e in enumerate(thing):
+        anchors = _anchors(e)
+        if anchors and anchors[-1] is not e:
+            anchor = anchors[-1]
+            leads, nullable, sensitive = _after(e, anchor)
+        else:
+            anchor = None
+            leads, nullable, sensitive = _leads(e)
+        if nullable:
+            leads = None
+        groups.setdefault(anchor, []).append((i, leads, sensitive))
+
+
+    result = []
+    useful = False
+    for anchor, options in groups.items():
+        chars = set()
+        for i, leads, sensitive in options:
+            if leads is not None:
+                chars.update(l[0] for l in leads)
+        table = {}
+        for c in chars:
+            table[c] = [(i, None if leads is None
+                         else tuple(l for l in leads if l[0] == c), sensitive)
+                        for i, leads, sensitive in options
+                        if leads is None or sensitive
+                        or any(l[0] == c for l in leads)]
+        default = [(i, None if leads is None else (), sensitive)
+                   for i, leads, sensitive in options
+                   if leads is None or sensitive]
+        if anchor is not None:
+            anchor = _compile(anchor, track)
+        if anchor is not None or len(default) < len(options):
+            useful = True
+        result.append((anchor, table, default, [o[0] for o in options]))
+
+    if not useful:
+        return None
+    return result
+
+
+def _viable_options(parser, offset, groups):
+    # Return the indices of the options which can match at offset according
+    # to the tables from _dispatch_groups()
+    text = parser.text
+    skipping = parser.comment or (parser.whitespace and not parser._contiguous)
+    viable = []
+    for anchor, table, default, indices in groups:
+        t = offset
+        if anchor is not None:
+            try:
+                t, r = anchor(parser, offset)
+            except GrammarValueError:
+                raise
+            except ValueError:
+                viable.extend(indices)
+                continue
+            if type(r) is _Failure:
+                continue
+        for i, leads, sensitive in table.get(text[t:t + 1], default):
+            if leads is None or (sensitive and skipping):
+                viable.append(i)
+            else:
+                for l in leads:
+                    if text.startswith(l, t):
+                        viable.append(i)
+                        break
+    if len(groups) > 1:
+        viable.sort()
+    return viable
+
+
 class Parser(object):
     """Offers parsing and composing capabilities. Implements a Packrat parser.
 
@@ -714,7 +1829,10 @@ class Parser(object):
         whitespace          regular expression to scan whitespace
                             default: "(?m)\s+"
         comment             grammar to parse comments
-        last_error          syntax error which ended parsing
+                            if neither whitespace nor comment is set, nothing
+                            is skipped between the things of the text
+        last_error          syntax error which ended the last parse of the
+                            current thread
         indent              string to use to indent while composing
                             default: four spaces
         indention_level     level to indent to
@@ -727,23 +1845,55 @@ class Parser(object):
                             default: True
         keep_feeble_things  put whitespace and comments into the .feeble_things
                             attribute instead of dumping them
+        memory_limit        maximum number of results kept in the packrat
+                            memory while parsing, None for no limit; a full
+                            memory forgets all results kept so far
+                            default: 100000
     """
 
-    def __init__(self):
-        """Initialize instance variables to their defaults."""
+    def __init__(self, whitespace=whitespace, comment=None, autoblank=True):
+        """Initialize instance variables to their defaults.
+
+        Arguments:
+            whitespace      regular expression to scan whitespace,
+                            None to keep all whitespace
+            comment         grammar to parse comments
+            autoblank       add blanks while composing if grammar would
+                            possibly be violated otherwise
+        """
+
         self.whitespace = whitespace
-        self.comment = None
-        self.last_error = None
+        self.comment = comment
         self.indent = "    "
         self.indention_level = 0
         self.text = None
         self.filename = None
-        self.autoblank = True
+        self.autoblank = autoblank
         self.keep_feeble_things = False
-        self._memory = {}
+        self.memory_limit = 100000
+        self.clear_memory()
+        self._skips = True
+        self._kinds = {}
         self._got_endl = True
         self._contiguous = False
         self._got_regex = False
+        self._sink = None
+        self._local = local()
+
+    @property
+    def last_error(self):
+        """Syntax error which ended the last parse of the current thread."""
+        context = getattr(self._local, "context", None)
+        if context is None:
+            return None
+        return context.last_error
+
+    @last_error.setter
+    def last_error(self, error):
+        context = getattr(self._local, "context", None)
+        if context is None:
+            context = self._local.context = _Context(self)
+        context.last_error = error
 
     def clear_memory(self, thing=None):
         """Clear cache memory for packrat parsing.
@@ -756,16 +1906,35 @@ class Parser(object):
 
         if thing is None:
             self._memory = {}
+            if self.memory_limit is None:
+                self._room = maxsize
+            else:
+                self._room = self.memory_limit
         else:
             try:
-                del self._memory[id(thing)]
+                self._room += len(self._memory.pop(id(thing)))
             except KeyError:
                 pass
 
+    def _remember(self, key, offset, result):
+        # Keep result in the packrat memory, forgetting everything kept so
+        # far if it is full
+        if self._room:
+            self._room -= 1
+        else:
+            self.clear_memory()
+        try:
+            self._memory[key][offset] = result
+        except KeyError:
+            self._memory[key] = { offset: result }
+
     def parse(self, text, thing, filename=None):
         """(Partially) parse text following thing as grammar and return the
         resulting things.
 
+        The text is never copied while parsing. The parser moves an offset
+        through it instead and only slices off the unparsed rest at the end.
+
         Arguments:
             text            text to parse
             thing           grammar for things to parse
@@ -784,14 +1953,48 @@ class Parser(object):
                             if grammar contains an illegal cardinality value
         """
 
+        # parsing works on its own context to leave the parser untouched
+        context = _Context(self)
+        try:
+            return context._parse_text(text, thing, filename)
+        finally:
+            self._local.context = context
+
+    def _parse_text(self, text, thing, filename):
+        # Parse text using the state of this parser
         self.text = text
         if filename:
             self.filename = filename
-        pos = [1, 0]
-        t, skip_result = self._skip(text, pos)
-        t, r = self._parse(t, thing, pos)
-        if type(r) == SyntaxError:
-            raise r
+
+        # the memory is keyed by input offsets, so results of earlier texts
+        # must not be reused
+        self.clear_memory()
+        self._kinds = {}
+        self.last_error = None
+
+        # remember where all lines start to find line numbers for offsets
+        self._lines = [0]
+        lf = text.find("\n")
+        while lf >= 0:
+            self._lines.append(lf + 1)
+            lf = text.find("\n", lf + 1)
+
+        # without whitespace and comments the matchers don't need to skip
+        # anything after every terminal
+        self._skips = bool(self.whitespace or self.comment)
+        if self._skips:
+            t, skip_result = self._skip(0, True)
+        else:
+            t, skip_result = 0, []
+        _analyse(thing)
+        try:
+            t, r = self._parse(t, thing)
+        finally:
+            # the results are not needed anymore once parsing is done
+            self.clear_memory()
+            self._kinds = {}
+        if type(r) is _Failure:
+            raise self.last_error
         else:
             if self.keep_feeble_things and skip_result:
                 try:
@@ -803,27 +2006,53 @@ class Parser(object):
                         pass
                 else:
                     r.feeble_things = skip_result + r.feeble_things
-            return t, r
+            return text[t:], r
 
-    def _skip(self, text, pos=None):
+    def _skip(self, offset, track=False):
         # Skip whitespace and comments from input text
         t2 = None
-        t = text
+        t = offset
         result = []
         while t2 != t:
             if self.whitespace and not self._contiguous:
-                t, r = self._parse(t, self.whitespace, pos)
-                if self.keep_feeble_things and r and not isinstance(r,
-                        SyntaxError):
+                t, r = self._parse(t, self.whitespace, track)
+                if self.keep_feeble_things and r and type(r) is not _Failure:
                     result.append(r)
             t2 = t
             if self.comment:
-                t, r = self._parse(t, self.comment, pos)
-                if self.keep_feeble_things and r and not isinstance(r,
-                        SyntaxError):
+                t, r = self._parse(t, self.comment, track)
+                if self.keep_feeble_things and r and type(r) is not _Failure:
                     result.append(r)
         return t, result
 
+    def _match(self, regex, offset):
+        # Match regex at offset without copying the text. Patterns which look
+        # at what precedes the offset are matched against the rest of the
+        # text instead to keep their meaning.
+        if _needs_rest(regex):
+            m = regex.match(self.text[offset:])
+            if m:
+                return m.group(0)
+        else:
+            m = regex.match(self.text, offset)
+            if m:
+                return m.group(0)
+        return None
+
+    def _line_kind(self, lines, offset):
+        # Look up the kind of the line at offset. All lines are classified
+        # at once the first time lines are used in a parse.
+        try:
+            kinds = self._kinds[lines]
+        except KeyError:
+            kinds = [lines.classify(self.text, start) for start in self._lines]
+            self._kinds[lines] = kinds
+        return kinds[bisect_right(self._lines, offset) - 1]
+
+    def _position(self, offset):
+        # Look up (lineNo, charInText) for an offset in the parsed text
+        return bisect_right(self._lines, offset), offset
+
     def generate_syntax_error(self, msg, pos):
             """Generate a syntax error construct with
 
@@ -834,110 +2063,110 @@ class Parser(object):
             result = SyntaxError(msg)
             if pos:
                 result.lineno = pos[0]
-                start = max(pos[1] - 19, 0)
-                end   = min(pos[1] + 20, len(self.text))
+
+                # show the text around the position, but only from its line
+                try:
+                    line_end = self._lines[pos[0]] - 1
+                except (AttributeError, IndexError):
+                    line_end = len(self.text)
+                try:
+                    line_start = self._lines[pos[0] - 1]
+                except (AttributeError, IndexError):
+                    line_start = 0
+                start = max(pos[1] - 19, line_start)
+                end   = min(pos[1] + 20, line_end)
                 result.text = self.text[start:end]
                 result.offset = pos[1] - start + 1
-                while "\n" in result.text:
-                    lf = result.text.find("\n")
-                    if lf >= result.offset:
-                        result.text = result.text[:result.offset-1]
-                        break;
-                    else:
-                        L = len(result.text)
-                        result.text = result.text[lf+1:]
-                        result.offset -= L - len(result.text)
                 if self.filename:
                     result.filename = self.filename
             return result
 
-    def _parse(self, text, thing, pos=[1, 0]):
+    def _parse_custom(self, offset, thing, track):
+        # Custom parse methods work on the rest of the text
+        if track:
+            pos = list(self._position(offset))
+        else:
+            pos = None
+        t, r = thing.parse(self, self.text[offset:], pos)
+        t = len(self.text) - len(t)
+        if isinstance(r, SyntaxError):
+            r = _Failure(t, thing, r)
+        else:
+            t, skip_result = self._skip(t)
+            if self.keep_feeble_things:
+                try:
+                    r.feeble_things
+                except AttributeError:
+                    try:
+                        r.feeble_things = skip_result
+                    except AttributeError:
+                        pass
+                else:
+                    r.feeble_things += skip_result
+        return t, r
+
+    def _parse(self, offset, thing, track=True):
         # Parser implementation
 
-        def update_pos(text, t, pos):
-            # Calculate where we are in the text
-            if not pos:
-                return
-            if text == t:
-                return
-            d_text = text[:len(text) - len(t)]
-            pos[0] += d_text.count("\n")
-            pos[1] += len(d_text)
+        # use the compiled grammar unless feeble things have to be kept,
+        # which changes the structure of the results
+        if not self.keep_feeble_things:
+            return _compile(thing, track)(self, offset)
 
         try:
-            return self._memory[id(thing)][text]
-        except:
+            return self._memory[id(thing)][offset]
+        except KeyError:
             pass
 
-        if pos:
-            current_pos = tuple(pos)
-        else:
-            current_pos = None
-
-        def syntax_error(msg):
-            return self.generate_syntax_error(msg, pos)
-
         try:
             thing.parse
         except AttributeError:
             pass
         else:
-            t, r = thing.parse(self, text, pos)
-            if not isinstance(r, SyntaxError):
-                t, skip_result = self._skip(t)
-                update_pos(text, t, pos)
-                if self.keep_feeble_things:
-                    try:
-                        r.feeble_things
-                    except AttributeError:
-                        try:
-                            r.feeble_things = skip_result
-                        except AttributeError:
-                            pass
-                    else:
-                        r.feeble_things += skip_result
-            return t, r
+            return self._parse_custom(offset, thing, track)
 
         skip_result = None
 
         # terminal symbols
 
         if thing is None or type(thing) == FunctionType:
-            result = text, None
+            result = offset, None
 
         elif isinstance(thing, Symbol):
-            m = type(thing).regex.match(text)
-            if m and m.group(0) == str(thing):
-                t, r = text[len(thing):], None
+            m = self._match(type(thing).regex, offset)
+            if m is not None and m == str(thing):
+                t, r = offset + len(m), None
                 t, skip_result = self._skip(t)
                 result = t, r
-                update_pos(text, t, pos)
             else:
-                result = text, syntax_error("expecting " + repr(thing))
+                result = offset, _Failure(offset, thing, None)
+
+        elif isinstance(thing, LineKind):
+            if self._line_kind(thing.lines, offset) in thing.kinds:
+                result = offset, None
+            else:
+                result = offset, _Failure(offset, thing, None)
 
         elif isinstance(thing, (RegEx, _RegEx)):
-            m = thing.match(text)
-            if m:
-                t, r = text[len(m.group(0)):], m.group(0)
+            m = self._match(thing, offset)
+            if m is not None:
+                t, r = offset + len(m), m
                 t, skip_result = self._skip(t)
                 result = t, r
-                update_pos(text, t, pos)
             else:
-                result = text, syntax_error("expecting match on "
-                        + thing.pattern)
+                result = offset, _Failure(offset, thing, None)
 
         elif isinstance(thing, (str, Literal)):
-            if text.startswith(str(thing)):
-                t, r = text[len(str(thing)):], None
+            if self.text.startswith(str(thing), offset):
+                t, r = offset + len(str(thing)), None
                 t, skip_result = self._skip(t)
                 result = t, r
-                update_pos(text, t, pos)
             else:
-                result = text, syntax_error("expecting " + repr(thing))
+                result = offset, _Failure(offset, thing, None)
 
         elif _issubclass(thing, Symbol):
-            m = thing.regex.match(text)
-            if m:
+            m = self._match(thing.regex, offset)
+            if m is not None:
                 result = None
                 try:
                     thing.grammar
@@ -947,31 +2176,29 @@ class Parser(object):
                     if thing.grammar is None:
                         pass
                     elif isinstance(thing.grammar, Enum):
-                        if not m.group(0) in thing.grammar:
-                            result = text, syntax_error(repr(m.group(0))
-                                + " is not a member of " + repr(thing.grammar))
+                        if not m in thing.grammar:
+                            result = offset, _Failure(offset, thing, m)
                     else:
                         raise GrammarValueError(
                                 "Symbol " + type(thing).__name__
                                 + " has a grammar which is not an Enum: "
                                 + repr(thing.grammar))
                 if not result:
-                    t, r = text[len(m.group(0)):], thing(m.group(0))
+                    t, r = offset + len(m), thing(m)
                     t, skip_result = self._skip(t)
                     result = t, r
-                    update_pos(text, t, pos)
             else:
-                result = text, syntax_error("expecting " + thing.__name__)
+                result = offset, _Failure(offset, thing, None)
 
         # non-terminal constructs
 
         elif isinstance(thing, attr.Class):
-            t, r = self._parse(text, thing.thing, pos)
-            if type(r) == SyntaxError:
+            t, r = self._parse(offset, thing.thing, track)
+            if type(r) is _Failure:
                 if thing.subtype == "Flag":
                     result = t, attr(thing.name, False)
                 else:
-                    result = text, r
+                    result = offset, r
             else:
                 if thing.subtype == "Flag":
                     result = t, attr(thing.name, True)
@@ -983,7 +2210,7 @@ class Parser(object):
                 L = List()
             else:
                 L = []
-            t = text
+            t = offset
             flag = True
             _min, _max = 1, 1
             contiguous = self._contiguous
@@ -1022,25 +2249,24 @@ class Parser(object):
                         _min, _max = e, e
                     continue
                 for i in range(_max):
-                    t2, r = self._parse(t, e, pos)
-                    if type(r) == SyntaxError:
+                    t2, r = self._parse(t, e, track)
+                    if type(r) is _Failure:
                         i -= 1
                         break
                     elif omit:
-                        t = t2
                         r = None
-                    else:
-                        t = t2
-                        if r is not None:
-                            if type(r) is list:
-                                L.extend(r)
-                            else:
-                                L.append(r)
+                    elif r is not None:
+                        if type(r) is list:
+                            L.extend(r)
+                        else:
+                            L.append(r)
+                    if t2 == t and _max == maxsize:
+                        # an empty match would be repeated forever
+                        break
+                    t = t2
                 if i+1 < _min:
-                    if type(r) != SyntaxError:
-                        r = syntax_error("expecting " + str(_min)
-                                + " occurrence(s) of " + repr(e)
-                                + " (" + str(i+1) + " found)")
+                    if type(r) is not _Failure:
+                        r = _Failure(t, thing, (_min, e, i+1))
                     flag = False
                     break
                 _min, _max = 1, 1
@@ -1092,15 +2318,15 @@ class Parser(object):
                                             L[0].feeble_things
                     result = t, L[0]
             else:
-                result = text, r
+                result = offset, r
             self._contiguous = contiguous
 
         elif isinstance(thing, list):
             found = False
             for e in thing:
                 try:
-                    t, r = self._parse(text, e, pos)
-                    if type(r) != SyntaxError:
+                    t, r = self._parse(offset, e, track)
+                    if type(r) is not _Failure:
                         found = True
                         break
                 except GrammarValueError:
@@ -1110,11 +2336,11 @@ class Parser(object):
             if found:
                 result = t, r
             else:
-                result = text, syntax_error("expecting one of " + repr(thing))
+                result = offset, _Failure(offset, thing, None)
 
         elif _issubclass(thing, Namespace):
-            t, r = self._parse(text, thing.grammar, pos)
-            if type(r) != SyntaxError:
+            t, r = self._parse(offset, thing.grammar, track)
+            if type(r) is not _Failure:
                 if isinstance(r, thing):
                     result = t, r
                 else:
@@ -1134,15 +2360,15 @@ class Parser(object):
                         pass
                     result = t, obj
             else:
-                result = text, r
+                result = offset, r
 
         elif _issubclass(thing, list):
             try:
                 g = thing.grammar
             except AttributeError:
                 g = csl(Symbol)
-            t, r = self._parse(text, g, pos)
-            if type(r) != SyntaxError:
+            t, r = self._parse(offset, g, track)
+            if type(r) is not _Failure:
                 if isinstance(r, thing):
                     result = t, r
                 else:
@@ -1164,15 +2390,15 @@ class Parser(object):
                         pass
                     result = t, obj
             else:
-                result = text, r
+                result = offset, r
 
         elif _issubclass(thing, object):
             try:
                 g = thing.grammar
             except AttributeError:
                 g = word
-            t, r = self._parse(text, g, pos)
-            if type(r) != SyntaxError:
+            t, r = self._parse(offset, g, track)
+            if type(r) is not _Failure:
                 if isinstance(r, thing):
                     result = t, r
                 else:
@@ -1216,19 +2442,21 @@ class Parser(object):
                         pass
                     result = t, obj
             else:
-                result = text, r
+                result = offset, r
 
         else:
             raise GrammarTypeError("in grammar: " + repr(thing))
 
-        if pos:
-            if type(result[1]) == SyntaxError:
-                pos[0] = current_pos[0]
-                pos[1] = current_pos[1]
-                self.last_error = result[1]
+        if track:
+            if type(result[1]) is _Failure:
+                # only remember the failure which got furthest
+                if (self._failure is None
+                        or result[1].offset >= self._failure.offset):
+                    self._failure = result[1]
+                    self._last_error = None
             else:
                 try:
-                    result[1].position_in_text = current_pos
+                    result[1].position_in_text = self._position(offset)
                 except AttributeError:
                     pass
 
@@ -1243,18 +2471,15 @@ class Parser(object):
             else:
                 result[1].feeble_things += skip_result
 
-        try:
-            self._memory[id(thing)]
-        except KeyError:
-            self._memory[id(thing)] = { text: result }
-        else:
-            self._memory[id(thing)][text] = result
-
+        self._remember(id(thing), offset, result)
         return result
 
-    def compose(self, thing, grammar=None, attr_of=None):
+    def compose(self, thing, grammar=None, attr_of=None, writer=None):
         """Compose text using thing with grammar.
 
+        Composing works on its own context, so a parser can be used by
+        several threads at once.
+
         Arguments:
             thing           thing containing other things with grammar
             grammar         grammar to use for composing thing
@@ -1263,8 +2488,14 @@ class Parser(object):
                             is a reference to the thing where this value
                             is an attribute of; None if this is not an
                             attribute value
+            writer          list or file like object (io.StringIO) the
+                            fragments of text are written to instead of
+                            returning them joined; they are written all at
+                            once when composing is done, as the text of
+                            failing elements is taken back until then
+                            default: None
 
-        Returns text
+        Returns text, or None if writing to writer
 
         Raises:
             ValueError      if thing does not match grammar
@@ -1273,10 +2504,46 @@ class Parser(object):
             GrammarValueError
                             if grammar contains an illegal cardinality value
         """
+
+        return _Context(self).compose(thing, grammar, attr_of, writer)
+
+    def write(self, *fragments):
+        """Write fragments of text while composing.
+
+        Compose methods of things can write their text with this method
+        instead of returning it; they return None then.
+        """
+
+        self._sink.extend(fragments)
+
+    def compose_into(self, thing, grammar=None, attr_of=None):
+        """Compose thing into the text being composed.
+
+        Compose methods of things can compose other things with this method
+        instead of composing them to text of their own and writing that.
+        The arguments are the same as for compose().
+        """
+
+        self._compose_to(thing, grammar, attr_of)
+
+    def _compose(self, thing, grammar=None, attr_of=None):
+        # Compose text using the state of this parser and return it
+        sink, self._sink = self._sink, []
+        try:
+            self._compose_to(thing, grammar, attr_of)
+            return "".join(self._sink)
+        finally:
+            self._sink = sink
+
+    def _compose_to(self, thing, grammar=None, attr_of=None):
+        # Compose text using the state of this parser and write it
         if __debug__:
             # make sure that we're not having this typing error
             compose = None
 
+        sink = self._sink
+        write = sink.append
+
         def terminal_indent(do_blank=False):
             self._got_regex = False
             if self._got_endl:
@@ -1296,7 +2563,11 @@ class Parser(object):
         except AttributeError:
             pass
         else:
-            return terminal_indent() + thing.compose(self, attr_of=attr_of)
+            write(terminal_indent())
+            text = thing.compose(self, attr_of=attr_of)
+            if text is not None:
+                write(text)
+            return
 
         if not grammar:
             try:
@@ -1313,63 +2584,84 @@ class Parser(object):
                     grammar = type(thing).regex
 
         if grammar is None:
-            result = ""
+            pass
 
         elif type(grammar) == FunctionType:
             if grammar == endl:
-                result = endl(thing, self)
+                write(endl(thing, self))
                 self._got_endl = True
             elif grammar == blank:
-                result = terminal_indent() + blank(thing, self)
+                write(terminal_indent() + blank(thing, self))
             else:
-                result = self.compose(thing, grammar(thing, self))
+                self._compose_to(thing, grammar(thing, self))
 
         elif isinstance(grammar, (RegEx, _RegEx)):
             m = grammar.match(str(thing))
             if m:
-                result = terminal_indent(do_blank=self._got_regex) + str(thing)
+                write(terminal_indent(do_blank=self._got_regex) + str(thing))
             else:
                 raise ValueError(repr(thing) + " does not match "
                         + grammar.pattern)
             self._got_regex = True
 
         elif isinstance(grammar, Keyword):
-            result = terminal_indent(do_blank=self._got_regex) + str(grammar)
+            write(terminal_indent(do_blank=self._got_regex) + str(grammar))
             self._got_regex = True
 
         elif isinstance(grammar, (str, int, Literal)):
-            result = terminal_indent() + str(grammar)
+            write(terminal_indent() + str(grammar))
+
+        elif isinstance(grammar, LineKind):
+            pass
 
         elif isinstance(grammar, Enum):
             if thing in grammar:
                 if isinstance(thing, Keyword):
-                    result = terminal_indent(do_blank=self._got_regex) + str(thing)
+                    write(terminal_indent(do_blank=self._got_regex) + str(thing))
                     self._got_regex = True
                 else:
-                    result = terminal_indent() + str(thing)
+                    write(terminal_indent() + str(thing))
             else:
                 raise ValueError(repr(thing) + " is not in " + repr(grammar))
 
         elif isinstance(grammar, attr.Class):
             if grammar.subtype == "Flag":
                 if getattr(thing, grammar.name):
-                    result = self.compose(thing, grammar.thing, attr_of=thing)
+                    self._compose_to(thing, grammar.thing, attr_of=thing)
                 else:
-                    result = terminal_indent()
+                    write(terminal_indent())
             else:
-                result = self.compose(getattr(thing, grammar.name),
+                self._compose_to(getattr(thing, grammar.name),
                         grammar.thing, attr_of=thing)
 
         elif isinstance(grammar, (tuple, list)):
-            def compose_tuple(thing, things, grammar):
-                text = []
+            # things are composed in their order without copying them, the
+            # index of the next one is kept in position
+            if isinstance(thing, Namespace):
+                things = list(thing.values())
+            elif isinstance(thing, list):
+                things = thing
+            else:
+                things = [thing]
+            position = [0]
+
+            def fits(g):
+                # Check if the next thing can be composed with the class g
+                if position[0] == len(things):
+                    return False
+                t = things[position[0]]
+                return isinstance(t, g) or (g == Symbol and isinstance(t, str))
+
+            def compose_tuple(thing, grammar):
+                # Returns False if grammar are options and none of them fits.
+                # Text written by elements which fail is taken back.
                 multiple, card = 1, 1
                 indenting = 0
                 if isinstance(grammar, (tuple, Concat)):
                     # concatenation
                     for g in grammar:
                         if g is None:
-                            multiple = 1
+                            multiple, card = 1, 1
                             if self.indenting:
                                 self.indention_level -= indenting
                                 self.indenting = 0
@@ -1386,35 +2678,58 @@ class Parser(object):
                                 if g == -3:
                                     self.indention_level += 1
                                     indenting += 1
+                                if g != 0:
+                                    # indent, contiguous and separated only
+                                    # change how thing is composed, it still
+                                    # has to be there
+                                    card = 1
                             elif g == -6:
                                 multiple = 0
                             else:
                                 multiple = g
+                        elif isinstance(g, LineKind):
+                            # kinds of lines only restrict parsing
+                            multiple = 1
                         else:
-                            passes = 0
+                            passes, missing = 0, False
                             try:
                                 for r in range(multiple):
+                                    written = len(sink)
                                     if isinstance(g, (str, Symbol, Literal)):
-                                        text.append(self.compose(thing, g))
+                                        self._compose_to(thing, g)
                                         if card < 1:
                                             break
                                     elif isinstance(g, FunctionType):
-                                        text.append(self.compose(thing, g))
+                                        self._compose_to(thing, g)
                                         if card < 1:
                                             break
                                     elif isinstance(g, attr.Class):
-                                        text.append(self.compose(getattr(thing,
-                                            g.name), g.thing, attr_of=thing))
+                                        self._compose_to(getattr(thing,
+                                            g.name), g.thing, attr_of=thing)
                                         if card < 1:
                                             break
                                     elif isinstance(g, (tuple, list)):
-                                        text.append(compose_tuple(thing, things, g))
-                                        if not things:
+                                        if not compose_tuple(thing, g):
+                                            missing = True
+                                            break
+                                        if position[0] == len(things):
                                             break
+                                    elif _issubclass(g, object):
+                                        if not fits(g):
+                                            missing = True
+                                            break
+                                        position[0] += 1
+                                        self._compose_to(
+                                                things[position[0] - 1], g)
                                     else:
-                                        text.append(self.compose(things.pop(), g))
+                                        position[0] += 1
+                                        self._compose_to(
+                                                things[position[0] - 1], g)
                                     passes += 1
                             except (IndexError, ValueError):
+                                del sink[written:]
+                                missing = True
+                            if missing:
                                 if card == -2:
                                     if passes < 1:
                                         raise ValueError(repr(g)
@@ -1424,30 +2739,38 @@ class Parser(object):
                                         raise ValueError(repr(g)
                                                 + " has to be there exactly "
                                                 + str(multiple) + " times")
-                            multiple = 1
+                            multiple, card = 1, 1
                             if indenting:
                                 self.indention_level -= indenting
                                 indenting = 0
-                    return ''.join(text)
+                    return True
                 else:
-                    # options
+                    # options, classes are chosen by the type of the next
+                    # thing
                     for g in grammar:
+                        written = len(sink)
                         try:
                             if isinstance(g, (str, Symbol, Literal)):
-                                return self.compose(thing, g)
+                                self._compose_to(thing, g)
+                                return True
                             elif isinstance(g, FunctionType):
-                                return self.compose(thing, g)
+                                self._compose_to(thing, g)
+                                return True
                             elif isinstance(g, attr.Class):
-                                return self.compose(getattr(thing, g.name), g.thing)
+                                self._compose_to(getattr(thing, g.name), g.thing)
+                                return True
                             elif isinstance(g, (tuple, list)):
-                                return compose_tuple(thing, things, g)
+                                if compose_tuple(thing, g):
+                                    return True
+                            elif _issubclass(g, object):
+                                if fits(g):
+                                    self._compose_to(things[position[0]], g)
+                                    position[0] += 1
+                                    return True
                             else:
-                                try:
-                                    text = self.compose(things[-1], g)
-                                except Exception as e:
-                                    raise e
-                                things.pop()
-                                return text
+                                self._compose_to(things[position[0]], g)
+                                position[0] += 1
+                                return True
                         except GrammarTypeError:
                             raise
                         except AttributeError:
@@ -1458,18 +2781,12 @@ class Parser(object):
                             pass
                         except ValueError:
                             pass
-                    raise ValueError("none of the options in " + repr(grammar)
-                            + " found")
+                        del sink[written:]
+                    return False
 
-            if isinstance(thing, Namespace):
-                L = [e for e in thing.values()]
-                L.reverse()
-            elif isinstance(thing, list):
-                L = thing[:]
-                L.reverse()
-            else:
-                L = [thing]
-            result = compose_tuple(thing, L, grammar)
+            if not compose_tuple(thing, grammar):
+                raise ValueError("none of the options in " + repr(grammar)
+                        + " found")
 
         elif _issubclass(grammar, object):
             if isinstance(thing, grammar):
@@ -1477,18 +2794,61 @@ class Parser(object):
                     grammar.grammar
                 except AttributeError:
                     if _issubclass(grammar, Symbol):
-                        result = self.compose(thing, grammar.regex)
+                        self._compose_to(thing, grammar.regex)
                     else:
-                        result = self.compose(thing)
+                        self._compose_to(thing)
                 else:
-                    result = self.compose(thing, grammar.grammar)
+                    self._compose_to(thing, grammar.grammar)
             else:
                 if grammar == Symbol and isinstance(thing, str):
-                    result = self.compose(str(thing), Symbol.regex)
+                    self._compose_to(str(thing), Symbol.regex)
                 else:
                     raise ValueError(repr(thing) + " is not a " + repr(grammar))
 
         else:
             raise GrammarTypeError("in grammar: " + repr(grammar))
 
-        return result
+
+class _Context(Parser):
+    # State of a single parse or compose run. It starts as a copy of the
+    # parser, so the grammar and the compose methods see the same
+    # configuration, but everything changed while parsing or composing
+    # stays here.
+
+    def __init__(self, parser):
+        self.__dict__.update(parser.__dict__)
+        self.last_error = None
+
+    @property
+    def last_error(self):
+        """Syntax error which ended parsing, generated from the failure which
+        got furthest into the text.
+        """
+        if self._last_error is None and self._failure is not None:
+            offset, thing, detail = self._failure
+            if isinstance(detail, SyntaxError):
+                self._last_error = detail
+            else:
+                self._last_error = self.generate_syntax_error(
+                        _error_message(thing, detail), self._position(offset))
+        return self._last_error
+
+    @last_error.setter
+    def last_error(self, error):
+        self._last_error = error
+        self._failure = None
+
+    def compose(self, thing, grammar=None, attr_of=None, writer=None):
+        # compose methods of things continue in the same context
+        if writer is None:
+            return self._compose(thing, grammar, attr_of)
+
+        sink, self._sink = self._sink, []
+        try:
+            self._compose_to(thing, grammar, attr_of)
+            try:
+                writer.writelines(self._sink)
+            except AttributeError:
+                writer.extend(self._sink)
+        finally:
+            self._sink = sink
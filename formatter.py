@@ -8,6 +8,12 @@ from . import texts
 
 original_rulers = None
 
+# the key of the regions modified since the last save
+modified_regions_key = "formatter_modified"
+
+# whether Sublime Text tells what text changed (since Sublime Text 4)
+text_change_listener = hasattr(sublime_plugin, "TextChangeListener")
+
 
 def debug():
     """Determine whether to we are in debugging mode."""
@@ -52,6 +58,10 @@ class FormatterCommand(sublime_plugin.TextCommand):
                 self.apply_rulers(restore=True)
             elif command == "format":
                 self.format()
+            elif command == "format_all":
+                self.format_all()
+            elif command == "format_modified":
+                self.format_modified()
         except Exception as e:
             # if an error occurs, open the console for the window where the
             # command was run in
@@ -79,20 +89,295 @@ class FormatterCommand(sublime_plugin.TextCommand):
             preferences.set("rulers", original_rulers)
             original_rulers = None
 
+    def find_scope(self, position):
+        """
+        Find what can be formatted at position.
+
+        Returns the scope, the function returning its formatted text and the
+        function formatting it in the view, or None if there is nothing.
+        """
+
+        if self.view.match_selector(position,
+                                    "comment.line"):
+            scope = comments.extract_line_comment_scope(self.view, position)
+            formatters = (comments.format_line_comment,
+                          comments.FormatLineComment)
+        elif self.view.match_selector(position,
+                                      "source.c++ comment.block.c"):
+            scope = comments.extract_cpp_block_comment_scope(self.view,
+                                                             position)
+            formatters = (comments.format_cpp_block_comment,
+                          comments.FormatDoxygenCppBlockComment)
+        elif self.view.match_selector(position,
+                                      "text.plain, text.html.markdown"):
+            scope = texts.extract_paragraph_scope(self.view, position)
+            formatters = (texts.format_paragraph, texts.FormatParagraph)
+        else:
+            return None
+
+        if not scope:
+            return None
+
+        return (scope,) + formatters
+
     def format(self):
         """Format the text at the current selection."""
 
-        # run a formatter based on the current selection
+        # find the formatter and the scope for every selection
+        scopes = set()
         for s in self.view.sel():
-            position = s.b
-            if self.view.match_selector(position,
-                                        "comment.line"):
-                comments.FormatLineComment(self.view, self.edit,
-                                           position)
-            elif self.view.match_selector(position,
-                                          "source.c++ comment.block.c"):
-                comments.FormatDoxygenCppBlockComment(self.view, self.edit,
-                                                      position)
-            elif self.view.match_selector(position,
-                                          "text.plain, text.html.markdown"):
-                texts.FormatParagraph(self.view, self.edit, position)
+            found = self.find_scope(s.b)
+            if found:
+                scope, formatter, format_in_view = found
+                scopes.add((scope.begin(), scope.end(), formatter))
+
+        self.format_scopes(scopes)
+
+    def format_modified(self):
+        """Format everything on the lines modified since the last save."""
+
+        # find the scopes at the end of all modified lines, remembering one
+        # position in each of them
+        scopes = {}
+        paragraphs = set()
+        for region in self.view.get_regions(modified_regions_key):
+            for line in self.view.lines(region):
+                if line.empty():
+                    continue
+
+                position = line.end() - 1
+                found = self.find_scope(position)
+                if found:
+                    scope, formatter, format_in_view = found
+                    key = (scope.begin(), scope.end())
+                    scopes.setdefault(key, (position, format_in_view))
+                    if formatter is texts.format_paragraph:
+                        paragraphs.add(key)
+
+        # leave Markdown markup alone like format_all does
+        if paragraphs:
+            kept = texts.without_markup(
+                [sublime.Region(begin, end)
+                 for begin, end in sorted(paragraphs)],
+                texts.find_markup(self.view))
+            for region in kept:
+                paragraphs.discard((region.begin(), region.end()))
+            for key in paragraphs:
+                del scopes[key]
+
+        # format them from the bottom up so the positions above stay where
+        # they are, skipping anything overlapping what was formatted already
+        last_begin = self.view.size()
+        for (begin, end), (position, format_in_view) in sorted(
+                scopes.items(), reverse=True):
+            if end > last_begin:
+                continue
+
+            try:
+                format_in_view(self.view, self.edit, position)
+            except (SyntaxError, ValueError, IndexError):
+                # leave anything that can't be formatted as it is and don't
+                # keep the file from being saved
+                pass
+
+            last_begin = begin
+
+    def format_all(self):
+        """Format all comments and paragraphs in the view."""
+
+        # find everything that can be formatted
+        scopes = set()
+        for extract, formatter in (
+                (comments.extract_line_comment_scopes,
+                 comments.format_line_comment),
+                (comments.extract_cpp_block_comment_scopes,
+                 comments.format_cpp_block_comment),
+                (texts.extract_paragraph_scopes,
+                 texts.format_paragraph)):
+            for scope in extract(self.view):
+                scopes.add((scope.begin(), scope.end(), formatter))
+
+        # leave anything as it is that can't be parsed
+        self.format_scopes(scopes, ignore_errors=True)
+
+    def format_scopes(self, scopes, ignore_errors=False):
+        """
+        Format scopes of text in the background.
+
+        Only the text is read here, it is parsed and composed in Sublime
+        Text's worker thread so typing doesn't have to wait for it. The
+        formatted text is then applied by the formatter_apply command unless
+        the view changed in the meantime.
+        """
+
+        view = self.view
+        window = view.window()
+        change_count = view.change_count()
+
+        if not scopes:
+            return
+
+        # read the text of all scopes at once
+        first = min(begin for begin, end, formatter in scopes)
+        last = max(end for begin, end, formatter in scopes)
+        text = view.substr(sublime.Region(first, last))
+
+        # take the scopes from the bottom up so the regions above stay where
+        # they are when replacing, and skip anything overlapping another scope
+        originals = []
+        last_begin = last
+        for begin, end, formatter in sorted(scopes, key=lambda s: s[:2],
+                                            reverse=True):
+            if end > last_begin:
+                continue
+
+            originals.append((begin, end, text[begin - first:end - first],
+                              formatter))
+            last_begin = begin
+
+        def format_originals():
+            try:
+                replacements = []
+                for begin, end, text, formatter in originals:
+                    try:
+                        formatted = formatter(view, text)
+                    except (SyntaxError, ValueError, IndexError):
+                        if ignore_errors:
+                            continue
+                        raise
+
+                    # never replace text by nothing
+                    if text and not formatted:
+                        if ignore_errors:
+                            continue
+                        raise ValueError("nothing was composed for %r" % text)
+
+                    if formatted != text:
+                        replacements.append((begin, end, formatted))
+            except Exception:
+                # open the console for the window where the command was run
+                # in for Sublime Text to print the exception there
+                window.run_command("show_panel", {"panel": "console"})
+                raise
+
+            if replacements:
+                sublime.set_timeout(lambda: view.run_command(
+                    "formatter_apply", {"change_count": change_count,
+                                        "replacements": replacements}))
+
+        sublime.set_timeout_async(format_originals)
+
+
+class FormatterApplyCommand(sublime_plugin.TextCommand):
+    """Sublime Text command for applying text formatted in the background."""
+
+    def run(self, edit, change_count, replacements):
+        """Run the command."""
+
+        # drop the formatted text if the view changed while formatting
+        if self.view.change_count() != change_count:
+            sublime.status_message("Formatting dropped as the text changed")
+            return
+
+        # the replacements are ordered from the bottom up
+        for begin, end, text in replacements:
+            self.view.replace(edit, sublime.Region(begin, end), text)
+
+
+def merge_regions(regions):
+    """Return the regions merged into sorted, non-overlapping regions."""
+
+    merged = []
+    for region in sorted(regions, key=lambda r: r.begin()):
+        if merged and region.begin() <= merged[-1].end():
+            merged[-1] = merged[-1].cover(region)
+        else:
+            merged.append(region)
+
+    return merged
+
+
+def remember_modified(view, regions):
+    """Remember the lines of regions as modified since the last save."""
+
+    if not view.settings().get("formatter_format_on_save"):
+        return
+
+    modified = view.get_regions(modified_regions_key)
+    modified.extend(view.line(r) for r in regions)
+    view.add_regions(modified_regions_key, merge_regions(modified), "", "",
+                     sublime.HIDDEN)
+
+
+def changed_regions(changes):
+    """Return the regions of the text written by changes once all are made."""
+
+    regions = []
+    for change in changes:
+        begin, end = change.a.pt, change.b.pt
+        length = len(change.str)
+
+        # move the regions of the earlier changes along with the text
+        def move(point):
+            if point <= begin:
+                return point
+            elif point >= end:
+                return point + length - (end - begin)
+            else:
+                return begin
+
+        regions = [sublime.Region(move(r.a), move(r.b)) for r in regions]
+        regions.append(sublime.Region(begin, begin + length))
+
+    return regions
+
+
+class FormatterListener(sublime_plugin.EventListener):
+    """
+    Sublime Text listener formatting modified text when saving.
+
+    This is enabled by the formatter_format_on_save setting. The lines of
+    modified text are remembered as regions of the view, which Sublime Text
+    moves along with the text, and only the comments and paragraphs on them
+    are formatted before saving.
+
+    Sublime Text 4 tells FormatterTextChangeListener what changed. Sublime
+    Text 3 only tells that the view was modified, so the lines of the
+    selections are remembered instead. Changes away from the selections,
+    like undoing, replacing all matches or pasting several lines, are
+    missed there.
+    """
+
+    def on_modified(self, view):
+        """Remember the lines of the selections on Sublime Text 3."""
+        if text_change_listener:
+            return
+
+        remember_modified(view, view.sel())
+
+    def on_pre_save(self, view):
+        """Format the modified lines."""
+        if not view.settings().get("formatter_format_on_save"):
+            return
+
+        view.run_command("formatter", {"command": "format_modified"})
+
+    def on_post_save(self, view):
+        """Forget the modified lines."""
+        view.erase_regions(modified_regions_key)
+
+
+if text_change_listener:
+    class FormatterTextChangeListener(sublime_plugin.TextChangeListener):
+        """Sublime Text 4 listener remembering the modified lines."""
+
+        @classmethod
+        def is_applicable(cls, buffer):
+            """Listen to all buffers."""
+            return True
+
+        def on_text_changed(self, changes):
+            """Remember the lines of the changed text in all views."""
+            regions = changed_regions(changes)
+            for view in self.buffer.views():
+                remember_modified(view, regions)
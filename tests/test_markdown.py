@@ -0,0 +1,86 @@
+"""
+Tests for formatting Markdown documents.
+
+They need Sublime Text and are run by the UnitTesting package.
+"""
+
+import sublime
+
+from unittesting import DeferrableTestCase
+
+paragraph = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed "
+             "do eiusmod tempor incididunt ut labore et dolore magna "
+             "aliqua.\n")
+
+wrapped_paragraph = ("Lorem ipsum dolor sit amet, consectetur adipiscing "
+                     "elit, sed do eiusmod tempor\nincididunt ut labore et "
+                     "dolore magna aliqua.\n")
+
+# blocks which are not paragraphs and must be left as they are
+markup = [
+    "```python\ndef f(x):\n    return x\n```\n",
+    "# Title\nSome text under it.\n",
+    "| a | b |\n|---|---|\n| 1 | 2 |\n",
+    "> quoted\n> text\n",
+    "    indented\n    code\n",
+]
+
+
+class TestMarkdown(DeferrableTestCase):
+    """Format Markdown documents without touching anything but paragraphs."""
+
+    def setUp(self):
+        """Open a Markdown view."""
+        self.view = sublime.active_window().new_file()
+        self.view.assign_syntax("Packages/Markdown/Markdown.sublime-syntax")
+        self.view.settings().set("rulers", [80])
+
+    def tearDown(self):
+        """Close the view without saving it."""
+        self.view.set_scratch(True)
+        self.view.window().focus_view(self.view)
+        self.view.window().run_command("close_file")
+
+    def set_text(self, text):
+        """Replace the text of the view."""
+        self.view.run_command("select_all")
+        self.view.run_command("right_delete")
+        self.view.run_command("append", {"characters": text})
+
+    def text(self):
+        """Return the text of the view."""
+        return self.view.substr(sublime.Region(0, self.view.size()))
+
+    def test_format_all_leaves_markup(self):
+        """format_all wraps the paragraphs and leaves all markup as it is."""
+
+        self.set_text("\n".join([paragraph] + markup + [paragraph]))
+        self.view.run_command("formatter", {"command": "format_all"})
+
+        # formatting is applied once it is done in the background
+        yield lambda: self.text().startswith(wrapped_paragraph)
+
+        self.assertEqual(self.text(),
+                         "\n".join([wrapped_paragraph] + markup
+                                   + [wrapped_paragraph]))
+
+    def test_format_on_save_leaves_markup(self):
+        """Formatting on save leaves markup with modified lines as it is."""
+
+        fence = markup[0]
+        self.set_text(paragraph + "\n" + fence)
+        self.view.settings().set("formatter_format_on_save", True)
+
+        # modify the paragraph and the code in the fence
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(0))
+        self.view.sel().add(sublime.Region(len(paragraph) + 1
+                                           + fence.index("x\n")))
+        self.view.run_command("insert", {"characters": "y"})
+
+        # what formatting on save does before saving
+        self.view.run_command("formatter", {"command": "format_modified"})
+
+        self.assertEqual(self.text(),
+                         "y" + wrapped_paragraph + "\n"
+                         + fence.replace("x\n", "yx\n", 1))
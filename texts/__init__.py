@@ -1,5 +1,14 @@
 """Plain text formatters."""
 
-from .paragraph import FormatParagraph
+from .paragraph import (
+    FormatParagraph,
+    extract_paragraph_scope,
+    extract_paragraph_scopes,
+    find_markup,
+    format_paragraph,
+    without_markup
+)
 
-__all__ = ["FormatParagraph"]
+__all__ = ["FormatParagraph", "extract_paragraph_scope",
+           "extract_paragraph_scopes", "find_markup", "format_paragraph",
+           "without_markup"]
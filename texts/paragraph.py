@@ -1,47 +1,125 @@
 """Format simple paragraphs."""
 
-import re
-
 import sublime
 
 from .paragraph_grammar import Paragraph
-from ..dependencies.pypeg2 import Parser
+from ..common.parsers import format_text, get_parser
 
 
-def extract_paragraph_scope(view, pos):
-    """Return the scope of paragraph."""
+# the number of characters read at once while searching backwards for the
+# start of a paragraph
+search_window = 4096
 
-    # find the current and the last row
-    row = view.rowcol(pos)[0]
-    max_rows = view.rowcol(view.size())[0]
+# the parts of Markdown documents which are not paragraphs of text and are
+# left as they are when formatting more than the paragraph at the cursor
+markup_selector = ("markup.raw - markup.raw.inline, meta.code-fence, "
+                   "markup.heading, meta.table, markup.quote, "
+                   "meta.disable-markdown")
 
-    # find the start of the paragraph by searching for the first empty line
-    # above
-    begin = -1
-    for l in range(row, -1, -1):
-        line = view.line(view.text_point(l, 0))
-        if line.empty():
-            break
 
-        begin = line.begin()
+def extract_paragraph_scope(view, pos):
+    """Return the scope of paragraph."""
 
-    if begin == -1:
+    line = view.line(pos)
+    if line.empty():
         # there is on paragraph
         return None
 
-    # find the end of the paragraph by checking the lines below
-    end = pos
-    for l in range(row + 1, max_rows + 1):
-        line = view.line(view.text_point(l, 0))
-        if line.empty():
+    # find the start of the paragraph by searching for the last empty line
+    # above in growing windows of text
+    begin = line.begin()
+    window = search_window
+    while begin > 0:
+        start = max(0, line.begin() - window)
+        text = view.substr(sublime.Region(start, line.begin()))
+        if start == 0:
+            # the text begins with an empty line if it begins with a newline
+            text = "\n" + text
+            start = -1
+
+        empty = text.rfind("\n\n")
+        if empty != -1:
+            begin = start + empty + 2
             break
+        elif start == -1:
+            begin = 0
+            break
+
+        window *= 2
 
-        end = line.end()
+    # find the end of the paragraph by searching for the next empty line
+    # below
+    empty = view.find(r"^$", line.end())
+    if empty is None or empty.begin() == -1:
+        end = view.size()
+    else:
+        end = empty.begin() - 1
 
     # return the region for all lines
     return view.full_line(sublime.Region(begin, end))
 
 
+def extract_paragraph_scopes(view):
+    """Return the scopes of all paragraphs in the view."""
+
+    scopes = []
+    for region in view.find_by_selector("text.plain, text.html.markdown"):
+        text = view.substr(region)
+
+        # paragraphs are the lines between empty lines
+        begin = None
+        offset = region.begin()
+        for line in text.split("\n"):
+            if line and begin is None:
+                begin = offset
+            elif not line and begin is not None:
+                scopes.append(sublime.Region(begin, offset))
+                begin = None
+
+            offset += len(line) + 1
+
+        if begin is not None:
+            scopes.append(sublime.Region(begin, region.end()))
+
+    return without_markup(scopes, find_markup(view))
+
+
+def find_markup(view):
+    """Return the regions of the markup which is not a paragraph."""
+
+    return view.find_by_selector(markup_selector)
+
+
+def without_markup(scopes, markup):
+    """
+    Return the scopes which don't overlap any of the regions of markup.
+
+    Both have to be sorted by their position in the view.
+    """
+
+    result = []
+    i = 0
+    for scope in scopes:
+        # skip the markup above the scope
+        while i < len(markup) and markup[i].end() <= scope.begin():
+            i += 1
+
+        if i == len(markup) or markup[i].begin() >= scope.end():
+            result.append(scope)
+
+    return result
+
+
+def format_paragraph(view, paragraph):
+    """Return the formatted paragraph."""
+
+    # get the parser for the view's settings
+    parser = get_parser(Paragraph, view)
+
+    # format the paragraph nicely, or take it from the recently formatted ones
+    return format_text(parser, paragraph, Paragraph)
+
+
 def FormatParagraph(view, edit, pos):
     """Format a paragraph."""
     if not view.match_selector(pos, "text.plain, text.html.markdown"):
@@ -54,25 +132,7 @@ def FormatParagraph(view, edit, pos):
 
     paragraph = view.substr(scope)
 
-    # initialize the parser
-    parser = Parser()
-    parser.text = paragraph
-    parser.whitespace = re.compile(r"\0")  # disable automatic removal
-    parser.autoblank = False
-
-    # custom parameters for the compose methods
-    rulers = view.settings().get("rulers", [])
-
-    parser.width = (rulers and rulers[0]) or 80
-    parser.tab_size = view.settings().get("tab_size")
-
-    # try to parse the original paragraph
-    t, c = parser.parse(paragraph, Paragraph)
-    if t:
-        raise parser.last_error
-
-    # format the paragraph nicely
-    formatted_paragraph = parser.compose(c)
+    formatted_paragraph = format_paragraph(view, paragraph)
 
     # update the view
     if formatted_paragraph != paragraph:
@@ -1,6 +1,5 @@
 """Grammar for paragraphs."""
 
-from textwrap import TextWrapper
 import re
 
 from ..dependencies.pypeg2 import (
@@ -10,6 +9,8 @@ from ..dependencies.pypeg2 import (
     maybe_some,
     some
 )
+from ..common.columns import columns
+from ..common.wrap import wrap
 
 
 Indentation = re.compile(r"[ \t]*")
@@ -27,24 +28,19 @@ class Text(List):
     def compose(self, parser, attr_of=None):
         # find the original line indentation and its length in characters
         indentation = self[0].indentation
-        indentation_length = len(indentation.expandtabs(parser.tab_size))
+        indentation_length = columns(indentation, parser.tab_size)
 
         # add the contents of all lines together
         contents = " ".join([l.contents.strip() for l in self if l.contents])
 
         # wrap the text at the remaining width
         width = parser.width - indentation_length
-        wrapper = TextWrapper(width=width,
-                              break_long_words=False,
-                              break_on_hyphens=False)
+        lines = wrap(contents, width, break_long_words=False,
+                     optimal=parser.optimal_wrapping)
 
-        lines = wrapper.wrap(contents)
-
-        # prepend the indentation to all lines
-        for i in range(0, len(lines)):
-            lines[i] = indentation + lines[i] + "\n"
-
-        return "".join(lines)
+        # write all lines with the indentation
+        for line in lines:
+            parser.write(indentation, line, "\n")
 
 
 ListItemStart = re.compile(r"[\+\-\*] ")
@@ -67,32 +63,22 @@ class ListItem(List):
     def compose(self, parser, attr_of=None):
         # find the original line indentation and its length in characters
         indentation = self[0].indentation
-        indentation_length = len(indentation.expandtabs(parser.tab_size))
+        indentation_length = columns(indentation, parser.tab_size)
 
         # add the contents of all lines together
         contents = " ".join([l.contents.strip() for l in self if l.contents])
 
         # wrap the text at the remaining width
         width = parser.width - indentation_length
-        wrapper = TextWrapper(width=width, initial_indent=self[0].start,
-                              break_long_words=False,
-                              break_on_hyphens=False)
-
         # indent all but the first lines with an additional level
-        wrapper.subsequent_indent = " " * parser.tab_size
-
-        lines = wrapper.wrap(contents)
-
-        # prepend the indentation to all lines
-        for i in range(0, len(lines)):
-            # turn the subsequent indentation into a tab character
-            if i > 0:
-                lines[i] = re.sub(r"^" + wrapper.subsequent_indent, "\t",
-                                  lines[i])
-
-            lines[i] = indentation + lines[i] + "\n"
-
-        return "".join(lines)
+        lines = wrap(contents, width, initial_indent=self[0].start,
+                     subsequent_indent="\t", tab_size=parser.tab_size,
+                     break_long_words=False,
+                     optimal=parser.optimal_wrapping)
+
+        # write all lines with the indentation
+        for line in lines:
+            parser.write(indentation, line, "\n")
 
 
 class ListItems(List):
@@ -0,0 +1,95 @@
+"""
+Generate the table of columns taken by characters in common/columns.py.
+
+The table is built from the Unicode database of the Python running this:
+combining marks, format characters except the soft hyphen and Hangul medial
+vowels and final consonants take no column, wide and fullwidth East Asian
+characters and unassigned code points of the ideographic planes take two and
+everything else takes one. Other unassigned code points take the columns of
+the code points before them to keep the table short.
+
+    python tools/gen_columns.py           rewrite the table
+    python tools/gen_columns.py --check   only check that it is up to date
+"""
+
+import os
+import re
+import sys
+import unicodedata
+
+path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "common", "columns.py")
+
+# the comment above the table and the table itself
+table_regex = re.compile(r"(from the Unicode )[0-9.]+( database)"
+                         r"(.*?\ntable = \(\n).*?(\n\)\n)", re.S)
+
+
+def code_point_columns(code_point):
+    """Return the columns taken by code_point or None if it's unassigned."""
+
+    char = chr(code_point)
+    category = unicodedata.category(char)
+    if category == "Cn":
+        return 2 if 0x20000 <= code_point <= 0x3FFFD else None
+    if (category in ("Mn", "Me")
+            or (category == "Cf" and code_point != 0xAD)
+            or 0x1160 <= code_point <= 0x11FF):
+        return 0
+    if unicodedata.east_asian_width(char) in ("W", "F"):
+        return 2
+    return 1
+
+
+def generate_table():
+    """Return the source of the entries of the table."""
+
+    ranges = []
+    for code_point in range(0x110000):
+        if 0xD800 <= code_point <= 0xDFFF:
+            # surrogates never occur in text
+            columns = 1
+        else:
+            columns = code_point_columns(code_point)
+            if columns is None:
+                columns = ranges[-1][1]
+
+        if not ranges or ranges[-1][1] != columns:
+            ranges.append((code_point, columns))
+
+    # fill the lines up to 79 characters
+    lines = []
+    line = "   "
+    for entry in ("(0x%05X, %d)," % r for r in ranges):
+        if len(line) + 1 + len(entry) > 79:
+            lines.append(line)
+            line = "   "
+        line += " " + entry
+    lines.append(line.rstrip(","))
+    return "\n".join(lines)
+
+
+def main():
+    """Rewrite or check the table."""
+
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+
+    generated = table_regex.sub(
+        lambda m: (m.group(1) + unicodedata.unidata_version + m.group(2)
+                   + m.group(3) + generate_table() + m.group(4)),
+        source, count=1)
+
+    if sys.argv[1:] == ["--check"]:
+        if generated != source:
+            sys.exit("%s is not up to date with Unicode %s"
+                     % (path, unicodedata.unidata_version))
+        print("%s is up to date with Unicode %s"
+              % (path, unicodedata.unidata_version))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(generated)
+
+
+if __name__ == "__main__":
+    main()